@@ -1,49 +1,75 @@
 """
 🦊 FoxFamilyTask Bot — Семейный менеджер задач (2026 Edition)
-aiogram 3.22.0 + PyQt6 6.10.0
+aiogram 3.22.0 + PyQt6 6.10.0 (+ orjson — необязательно, ускоряет работу с БД;
++ redis — необязательно, хранит состояния диалогов в Redis при заданном REDIS_URL)
 Полностью переработанная архитектура диалогов с контекстным меню
 """
 
 import asyncio
+import atexit
+import heapq
 import json
 import logging
+import logging.handlers
 import os
+import random
 import re
 import secrets
 import sys
+import threading
 import time
 import uuid
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import count, islice
 from datetime import timezone
 from pathlib import Path
-from typing import Any, Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 from dotenv import load_dotenv  # Для безопасного хранения токена
 
+try:
+    import orjson  # Быстрая сериализация БД (необязательная зависимость)
+except ImportError:
+    orjson = None
+
+try:
+    import qasync  # asyncio-цикл поверх цикла Qt — бот без отдельного потока (необязательно)
+except ImportError:
+    qasync = None
+
 # ────────────────────────────────────────────────
 # Импорты PyQt6 (версия 6.10.0)
 # ────────────────────────────────────────────────
-from PyQt6.QtCore import QObject, QThread, pyqtSignal, Qt
-from PyQt6.QtGui import QFont, QIcon
+from PyQt6.QtCore import QThread, pyqtSignal, Qt
+from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import (
     QApplication, QFileDialog, QLabel, QLineEdit, QMessageBox, QPushButton,
-    QStackedWidget, QVBoxLayout, QWidget, QMainWindow, QTextEdit, QComboBox,
-    QCheckBox, QHBoxLayout, QFrame, QScrollArea, QGridLayout
+    QStackedWidget, QVBoxLayout, QWidget, QMainWindow, QTextEdit, QHBoxLayout
 )
 
 # ────────────────────────────────────────────────
 # Импорты aiogram (версия 3.22.0)
 # ────────────────────────────────────────────────
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
+
+try:
+    # Состояния FSM в Redis — переживают перезапуск бота (необязательно, нужен пакет redis)
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+except ImportError:
+    RedisStorage = None
 from aiogram.types import (
     CallbackQuery, KeyboardButton, Message, ReplyKeyboardMarkup,
     ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 )
-from aiogram.utils.formatting import Text, Bold, Italic, Code
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from PyQt6.QtCore import QSettings
 
@@ -53,12 +79,20 @@ from PyQt6.QtCore import QSettings
 load_dotenv()  # Загружаем .env для токена
 
 LOG_FILE = "foxfamily.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024  # Размер лог-файла до ротации
+LOG_BACKUP_COUNT = 3  # Сколько старых логов хранить
 DB_PATH = Path("foxfamily_db.json")
+UPDATES_DIR = Path("updates")  # Журналы истории задач: updates_<fam_id>.jsonl
 ENV_PATH = Path(".env")
 
 # ────────────────────────────────────────────────
 # Анимации и визуальные эффекты
 # ────────────────────────────────────────────────
+HR_LINE = "─" * 30  # Разделитель в карточках задач и списках покупок
+
+# Повторяющиеся ответы-алерты
+ERR_ACCESS = "❌ Ошибка доступа!"
+ERR_TASK_NOT_FOUND = "❌ Задача не найдена!"
 SPIN_FRAMES = ["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"]
 
 
@@ -83,16 +117,9 @@ def fancy_progress_bar(pct: int) -> str:
     return f"{bar} {pct}%"
 
 
-# Безопасная загрузка токена из .env
+# Токен из окружения — .env уже загружен load_dotenv() при импорте
 def get_telegram_token() -> str:
-    if ENV_PATH.exists():
-        with open(ENV_PATH, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip() and not line.startswith("#"):
-                    key, _, value = line.partition("=")
-                    if key.strip() == "TELEGRAM_BOT_TOKEN":
-                        return value.strip().strip('"').strip("'")
-    return ""
+    return os.environ.get("TELEGRAM_BOT_TOKEN", "").strip().strip('"').strip("'")
 
 
 # Константы
@@ -100,6 +127,14 @@ KEY_LENGTH_BYTES = 48
 KEY_EXPIRY_SEC = 600
 MAX_FREE_MEMBERS = 25
 WARN_MEMBERS_THRESHOLD = 20
+ONE_HOUR = timedelta(hours=1)  # Допуск для дедлайна «в прошлом»
+POLLING_TIMEOUT = 30  # Секунды long polling в getUpdates
+NOTIFY_CONCURRENCY = 20  # Одновременных отправок при рассылке по семье
+# Пул keep-alive соединений к Bot API: рассылка + long polling + ответы хендлеров
+HTTP_POOL_LIMIT = NOTIFY_CONCURRENCY * 2
+# Потоки цикла событий нужны только для записи БД, а она сериализована _DB_WRITE_LOCK
+EXECUTOR_WORKERS = 2
+TOKEN_RE = re.compile(r"^\d+:[A-Za-z0-9_-]+$")  # Формат токена Telegram-бота
 
 REMINDER_OPTIONS = {
     "🚫 Без напоминаний": 0,
@@ -118,26 +153,54 @@ TASK_TYPES = {
     "🎂 Событие": "event"
 }
 
+# Обратные таблицы: значение → подпись кнопки
+REMINDER_DISPLAY = {v: k for k, v in REMINDER_OPTIONS.items()}
+TASK_TYPES_DISPLAY = {v: k for k, v in TASK_TYPES.items()}
+
+TASK_TYPE_EMOJI = {
+    "shopping": "🛒", "trip": "🚗", "cleaning": "🧹",
+    "event": "🎂", "regular": "📝"
+}
+
+# Префиксы callback_data: идентификатор берётся срезом без str.split
+CB_TASK_EDIT = "task:edit:"
+CB_TASK_PROGRESS = "task:progress:"
+CB_TASK_ITEMS = "task:items:"
+CB_TASK_COMPLETE = "task:complete:"
+CB_ITEM_CHECK = "item:check:"
+CB_TASK_QUICKPCT = "task:quickpct:"
+CB_ENTER_FAMILY = "enter_family:"
+CB_TASK_TYPE = "task_type:"
+CB_SHOP_CAT = "shop_cat:"
+CB_REMINDER = "reminder:"
+
 # ────────────────────────────────────────────────
 # Настройка логирования
 # ────────────────────────────────────────────────
+# Файл открывается при первой записи и ротируется по размеру; INFO копится пачкой до 100 строк,
+# ERROR сбрасывает сразу
+_file_handler = logging.handlers.RotatingFileHandler(
+    LOG_FILE, mode="a", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True
+)
+_file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+
 logging.basicConfig(
     level=logging.INFO,
-    filename=LOG_FILE,
-    filemode="a",
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    encoding="utf-8",
+    handlers=[
+        logging.handlers.MemoryHandler(100, flushLevel=logging.ERROR, target=_file_handler),
+        _console_handler,
+    ],
 )
 
 
 def log_info(msg: str) -> None:
     logging.info(msg)
-    print(f"[INFO] {msg}")
 
 
 def log_error(msg: str) -> None:
     logging.error(msg)
-    print(f"[ERROR] {msg}")
 
 
 # ────────────────────────────────────────────────
@@ -168,21 +231,27 @@ class FamilyStates(StatesGroup):
 # ────────────────────────────────────────────────
 # Утилиты для БД — исправлена гонка условий
 # ────────────────────────────────────────────────
-def load_db() -> Dict[str, Any]:
-    """Безопасная загрузка БД с валидацией структуры БЕЗ перезаписи"""
+def parse_db(raw: bytes) -> Any:
+    """Разбор содержимого файла БД (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def read_db_file() -> Dict[str, Any]:
+    """Безопасное чтение БД с диска с валидацией структуры БЕЗ перезаписи"""
     if DB_PATH.exists():
         try:
-            with open(DB_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if not isinstance(data, dict):
-                    raise ValueError("Invalid DB structure")
-                # Добавляем недостающие поля БЕЗ перезаписи существующих
-                data.setdefault("families", {})
-                data.setdefault("users", {})
-                data.setdefault("settings", {"default_timezone": "UTC"})
-                data.setdefault("data_folder", str(Path.cwd()))
-                data.setdefault("output_base", str(Path.cwd() / "output"))
-                return data
+            data = parse_db(DB_PATH.read_bytes())
+            if not isinstance(data, dict):
+                raise ValueError("Invalid DB structure")
+            # Добавляем недостающие поля БЕЗ перезаписи существующих
+            data.setdefault("families", {})
+            data.setdefault("users", {})
+            data.setdefault("settings", {"default_timezone": "UTC"})
+            data.setdefault("data_folder", str(Path.cwd()))
+            data.setdefault("output_base", str(Path.cwd() / "output"))
+            return data
         except Exception as e:
             log_error(f"Load DB error: {e}. Creating backup and new DB.")
             # Создаём бэкап битой БД
@@ -198,18 +267,168 @@ def load_db() -> Dict[str, Any]:
     }
 
 
-def atomic_save_db(db: Dict[str, Any]) -> None:
-    """Атомарное сохранение БД без гонки условий"""
+# Единственная копия БД в памяти процесса — читается с диска один раз
+_DB_CACHE: Optional[Dict[str, Any]] = None
+_DB_DIRTY = asyncio.Event()  # Пересоздаётся в start_bot — событие привязывается к циклу первого wait()
+_pending_writes = 0
+DB_FLUSH_DELAY = 0.5  # Окно склейки записей, сек
+DB_FLUSH_BATCH = 20  # Столько изменений подряд пишем сразу, не дожидаясь окна
+DB_FLUSH_RETRY_DELAY = 5  # Пауза перед повтором после неудачной записи, сек
+# GUI (главный поток) и бот (BotThread) пишут через один .tmp — сериализуем запись
+_DB_WRITE_LOCK = threading.Lock()
+# Снимки БД нумеруются в момент сериализации: запись из пула потоков может опоздать,
+# и более старый снимок не должен затереть уже записанный новый
+_DB_SNAPSHOT_SEQ = count(1)
+_db_written_seq = 0
+
+
+def load_db() -> Dict[str, Any]:
+    """Возвращает живой словарь БД из памяти (загружает с диска при первом вызове)"""
+    global _DB_CACHE
+    if _DB_CACHE is None:
+        _DB_CACHE = read_db_file()
+    return _DB_CACHE
+
+
+def _take_pending_writes() -> int:
+    """Забирает счётчик несохранённых изменений; при неудачной записи его возвращает _restore_pending_writes"""
+    global _pending_writes
+    pending = _pending_writes
+    _pending_writes = 0
+    _DB_DIRTY.clear()
+    return pending
+
+
+def _restore_pending_writes(pending: int) -> None:
+    """Запись не удалась — изменения снова считаются несохранёнными, flush_loop повторит попытку"""
+    global _pending_writes
+    _pending_writes += pending  # Плюс то, что успело накопиться во время записи
+    _DB_DIRTY.set()
+
+
+def flush_db() -> None:
+    """Немедленно записывает накопленные изменения (если они есть)"""
+    pending = _take_pending_writes()
+    if not pending:
+        return
+    try:
+        atomic_save_db(load_db())
+    except Exception:
+        _restore_pending_writes(pending)
+        raise
+
+
+async def flush_db_async() -> None:
+    """Как flush_db, но запись и fdatasync идут в пуле потоков и не блокируют цикл событий"""
+    pending = _take_pending_writes()
+    if not pending:
+        return
+    # Снимок снимается здесь, в цикле событий, — хендлеры не меняют БД посреди сериализации
+    seq = next(_DB_SNAPSHOT_SEQ)
+    try:
+        await asyncio.to_thread(write_db_bytes, dump_db(load_db()), seq)
+    except Exception:
+        _restore_pending_writes(pending)
+        raise
+
+
+def mark_db_dirty() -> None:
+    """Помечает БД изменённой — запись выполнит flush_loop (сразу, если набралась пачка DB_FLUSH_BATCH)"""
+    global _pending_writes
+    _pending_writes += 1
+    _DB_DIRTY.set()
+
+
+async def flush_loop() -> None:
+    """Фоновая отложенная запись: склеивает изменения за DB_FLUSH_DELAY в одну запись"""
+    while True:
+        await _DB_DIRTY.wait()
+        if _pending_writes < DB_FLUSH_BATCH:
+            await asyncio.sleep(DB_FLUSH_DELAY)
+        try:
+            await flush_db_async()
+        except Exception as e:
+            log_error(f"Failed to flush DB: {e}")
+            await asyncio.sleep(DB_FLUSH_RETRY_DELAY)  # Не долбим диск, если он полон или недоступен
+
+
+atexit.register(flush_db)  # Ничего не теряем при выходе из процесса
+
+
+def dump_db(db: Dict[str, Any]) -> bytes:
+    """Сериализация БД сразу в байты (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(db, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(db, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# fdatasync не сбрасывает лишние метаданные inode; там, где его нет (Windows, macOS), — fsync
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def write_db_bytes(data: bytes, seq: int) -> None:
+    """Атомарная запись готового снимка БД — один буфер, прямой os.write; устаревший снимок пропускается"""
+    global _db_written_seq
     temp = DB_PATH.with_suffix(".tmp")
     try:
-        with open(temp, "w", encoding="utf-8") as f:
-            json.dump(db, f, indent=2, ensure_ascii=False)
-        temp.replace(DB_PATH)
+        with _DB_WRITE_LOCK:
+            if seq < _db_written_seq:
+                return
+            buf = memoryview(data)
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+                fdatasync(fd)  # Данные на диске до rename — иначе после сбоя питания возможен пустой файл
+            finally:
+                os.close(fd)
+            temp.replace(DB_PATH)
+            _db_written_seq = seq
     except Exception as e:
         log_error(f"Atomic save error: {e}")
         raise
 
 
+def atomic_save_db(db: Dict[str, Any]) -> None:
+    """Атомарное сохранение БД без гонки условий (синхронно, в вызывающем потоке)"""
+    global _DB_CACHE
+    write_db_bytes(dump_db(db), next(_DB_SNAPSHOT_SEQ))
+    _DB_CACHE = db
+
+
+def journal_path(fam_id: str) -> Path:
+    return UPDATES_DIR / f"updates_{fam_id}.jsonl"
+
+
+def append_task_update(fam_id: str, task_id: str, task: Dict[str, Any], entry: Dict[str, Any]) -> None:
+    """Дописывает запись истории задачи в журнал семьи (JSONL) вместо хранения в основной БД"""
+    task["last_update_ts"] = entry["timestamp"]
+    # Старые задачи хранят историю прямо в БД — переносим её в журнал при первом обновлении
+    legacy = task.get("updates") or []
+    line = b"".join(dump_db({"task_id": task_id, **e}) + b"\n" for e in (*legacy, entry))
+    try:
+        try:
+            with open(journal_path(fam_id), "ab") as f:
+                f.write(line)
+        except FileNotFoundError:
+            UPDATES_DIR.mkdir(parents=True, exist_ok=True)
+            with open(journal_path(fam_id), "ab") as f:
+                f.write(line)
+    except OSError as e:
+        log_error(f"Task journal write error for family {fam_id}: {e}")
+        return
+    # Из БД историю убираем только после того, как она надёжно попала в журнал
+    task.pop("updates", None)
+
+
+def drop_family_journal(fam_id: str) -> None:
+    """Удаляет журнал истории задач удалённой семьи"""
+    try:
+        journal_path(fam_id).unlink(missing_ok=True)
+    except OSError as e:
+        log_error(f"Task journal delete error for family {fam_id}: {e}")
+
+
 def generate_family_key() -> Dict[str, Any]:
     """Генерация безопасного ключа приглашения"""
     return {
@@ -219,6 +438,16 @@ def generate_family_key() -> Dict[str, Any]:
     }
 
 
+def generate_task_id(fam: Dict[str, Any]) -> str:
+    """Короткий ID задачи: миллисекунды + 16 случайных бит; при совпадении с задачей семьи генерируется заново"""
+    tasks = fam.get("tasks", {})
+    completed = fam.get("completed_tasks", {})
+    while True:
+        task_id = f"{int(time.time() * 1000):x}{random.getrandbits(16):04x}"
+        if task_id not in tasks and task_id not in completed:
+            return task_id
+
+
 def is_key_valid(key_input: str, family: Dict[str, Any]) -> bool:
     """Валидация ключа без гонки условий (изменения возвращаются через аргумент)"""
     kd = family.get("active_key")
@@ -227,40 +456,194 @@ def is_key_valid(key_input: str, family: Dict[str, Any]) -> bool:
     if time.time() > kd["expires"]:
         family["active_key"] = None  # Изменение в переданном объекте
         return False
-    return secrets.compare_digest(key_input.strip(), kd["value"])
+    key = key_input.strip()
+    # Длина ключа фиксирована и не секретна — неподходящие отсекаем без сравнения.
+    # compare_digest для str принимает только ASCII, иначе TypeError
+    if len(key) != len(kd["value"]) or not key.isascii():
+        return False
+    return secrets.compare_digest(key, kd["value"])
+
+
+def resolve_fam(db: Dict[str, Any], uid: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Текущая семья пользователя: (fam_id, семья); семья None, если её нет"""
+    fam_id = db["users"].get(uid, {}).get("current_family")
+    return fam_id, (db["families"].get(fam_id) if fam_id else None)
+
+
+def get_key_index(db: Dict[str, Any]) -> Dict[str, str]:
+    """Индекс «ключ приглашения → fam_id» (строится из active_key при первом обращении)"""
+    index = db.get("_key_index")
+    if index is None:
+        index = db["_key_index"] = {  # Ленивая миграция
+            fam["active_key"]["value"]: fam_id
+            for fam_id, fam in db["families"].items() if fam.get("active_key")
+        }
+    return index
+
+
+def set_family_key(db: Dict[str, Any], fam_id: str, key_data: Optional[Dict[str, Any]]) -> None:
+    """Меняет ключ приглашения семьи (None — убрать) вместе с записью в индексе"""
+    fam = db["families"].get(fam_id)
+    if fam is None:
+        return
+    index = get_key_index(db)
+    old = fam.get("active_key")
+    if old:
+        index.pop(old["value"], None)
+    fam["active_key"] = key_data
+    if key_data:
+        index[key_data["value"]] = fam_id
+
+
+def get_member_uids(fam: Dict[str, Any]) -> List[int]:
+    """Список chat_id участников семьи (поддерживается при входе/выходе)"""
+    uids = fam.get("_member_uids")
+    if uids is None:
+        uids = fam["_member_uids"] = [int(u) for u in fam.get("members", {})]  # Ленивая миграция
+    return uids
+
+
+def add_member(fam: Dict[str, Any], uid: str, member: Dict[str, Any]) -> None:
+    """Добавляет участника в семью, синхронизируя список chat_id"""
+    uids = get_member_uids(fam)
+    if uid not in fam["members"]:
+        uids.append(int(uid))
+    fam["members"][uid] = member
+
+
+@lru_cache(maxsize=1024)
+def _format_joined(ts: float, full: bool) -> str:
+    return datetime.fromtimestamp(ts).strftime("%d.%m.%Y" if full else "%d.%m")
+
+
+def get_joined_str(member: Dict[str, Any], full: bool = False) -> str:
+    """Дата вступления участника («дд.мм» или «дд.мм.гггг»); кэш в памяти процесса, в БД не пишется"""
+    # Строки, сохранённые в записи участника прежними версиями
+    member.pop("joined_str_short", None)
+    member.pop("joined_str_full", None)
+    return _format_joined(member["joined"], full)
+
+
+def remove_member(fam: Dict[str, Any], uid: str) -> Optional[Dict[str, Any]]:
+    """Удаляет участника из семьи, синхронизируя список chat_id"""
+    member = fam["members"].pop(uid, None)
+    if member is not None and int(uid) in get_member_uids(fam):
+        fam["_member_uids"].remove(int(uid))
+    return member
 
 
 # ────────────────────────────────────────────────
 # Утилиты UI
 # ────────────────────────────────────────────────
+# Все 11 состояний полосы и готовые строки для каждого процента 0..100 — строятся один раз
+_BARS = tuple(f"[{'●' * i}{'○' * (10 - i)}]" for i in range(11))
+_PROGRESS_BARS = tuple(f"{_BARS[i // 10]} {i}%" for i in range(101))
+
+
 def progress_bar(pct: int) -> str:
     """Визуальный прогресс-бар с эмодзи"""
-    filled = min(10, max(0, pct // 10))
-    return f"[{'●' * filled}{'○' * (10 - filled)}] {pct}%"
+    if 0 <= pct <= 100:
+        return _PROGRESS_BARS[pct]
+    return f"{_BARS[min(10, max(0, pct // 10))]} {pct}%"
 
 
-def format_deadline(deadline_str: str) -> str:
-    """Форматирование дедлайна для отображения"""
+def format_deadline(deadline_str: str, ts: Optional[float] = None) -> str:
+    """Форматирование дедлайна для отображения (ts — результат get_deadline_ts задачи)"""
     try:
-        dt = datetime.strptime(deadline_str, "%d.%m.%Y %H:%M")
-        now = datetime.now()
-        delta = dt - now
-
-        if delta.days < 0:
-            return f"⏱️ {deadline_str} (просрочено!)"
-        elif delta.days == 0:
-            hours = int(delta.total_seconds() // 3600)
-            if hours <= 1:
-                return f"🔥 {deadline_str} (менее часа!)"
-            return f"⏰ {deadline_str} (сегодня)"
-        elif delta.days == 1:
-            return f"🌅 {deadline_str} (завтра)"
-        else:
-            return f"📅 {deadline_str} ({delta.days} дн.)"
-    except:
+        if ts is None:
+            ts = datetime.strptime(deadline_str, "%d.%m.%Y %H:%M").timestamp()
+    except (TypeError, ValueError):
         return f"📅 {deadline_str}"
+    if ts == float('inf'):  # Дедлайн не разобрался
+        return f"📅 {deadline_str}"
+
+    # Целые дни/часы до дедлайна — та же семантика, что у timedelta.days
+    delta = ts - time.time()
+    days = int(delta // 86400)
+
+    if days < 0:
+        return f"⏱️ {deadline_str} (просрочено!)"
+    elif days == 0:
+        if delta < 7200:
+            return f"🔥 {deadline_str} (менее часа!)"
+        return f"⏰ {deadline_str} (сегодня)"
+    elif days == 1:
+        return f"🌅 {deadline_str} (завтра)"
+    else:
+        return f"📅 {deadline_str} ({days} дн.)"
+
+
+def get_deadline_ts(task: Dict[str, Any]) -> float:
+    """Дедлайн задачи как Unix-время; разобранное значение кэшируется в task["deadline_ts"]"""
+    ts = task.get("deadline_ts")
+    if ts is not None:
+        return ts
+    deadline_str = task.get("deadline")
+    if not deadline_str:
+        return float('inf')
+    try:
+        ts = datetime.strptime(deadline_str, "%d.%m.%Y %H:%M").timestamp()
+    except ValueError:
+        return float('inf')
+    task["deadline_ts"] = ts  # Ленивая миграция старых задач
+    return ts
+
+
+@lru_cache(maxsize=1024)
+def _format_completed_at(ts: float) -> str:
+    return datetime.fromtimestamp(ts).strftime("%d.%m %H:%M")
+
+
+def get_completed_at_str(task: Dict[str, Any]) -> str:
+    """Время завершения задачи «дд.мм чч:мм»; кэш в памяти процесса, в БД не пишется"""
+    task.pop("_completed_at_str", None)  # Строка, сохранённая в БД прежними версиями
+    return _format_completed_at(task.get("completed_at", task["created_at"]))
+
+
+def get_unchecked_count(task: Dict[str, Any]) -> int:
+    """Сколько товаров в списке ещё не куплено (счётчик хранится в задаче)"""
+    count = task.get("items_unchecked_count")
+    if count is None:
+        count = sum(not c for c in task.get("items_checked", []))
+        task["items_unchecked_count"] = count  # Ленивая миграция старых задач
+    return count
+
+
+def sort_tasks_by_deadline(tasks: Dict[str, Any]) -> List[tuple]:
+    """Сортировка задач по приближению дедлайна (тривиальные списки не сортируются)"""
+    if len(tasks) <= 1 or not any(t.get("deadline") for t in tasks.values()):
+        return list(tasks.items())
+    return sorted(tasks.items(), key=lambda x: get_deadline_ts(x[1]))
+
+
+@lru_cache(maxsize=1024)
+def _task_row_template(task_type: str, progress: int, desc: str, assignees: tuple) -> str:
+    """Шаблон строки задачи — кэшируется в памяти процесса по всем полям, от которых зависит"""
+    task_type_emoji = TASK_TYPE_EMOJI.get(task_type, "📝")
+    bar = progress_bar(progress).replace("%", "%%")
+    desc = desc.replace("%", "%%")
+    assignees_str = (", ".join(assignees) or "не назначена").replace("%", "%%")
+    return (
+        f"{task_type_emoji} <b>%d. {desc}</b>\n"
+        f"   {bar} | %s\n"
+        f"   👥 Исполнители: {assignees_str}\n"
+    )
+
+
+def render_task_row(task: Dict[str, Any]) -> str:
+    """Шаблон строки задачи для списка.
+
+    Номер и дедлайн подставляются через % при выводе — «сегодня»/«просрочено» зависят от времени.
+    Кэш живёт только в памяти: в файл БД разметка не попадает и не устаревает после обновления кода.
+    """
+    task.pop("_html_row", None)  # Разметка, сохранённая в БД прежними версиями
+    return _task_row_template(
+        task["type"], task.get("progress", 0), task["desc"], tuple(task.get("assignees", ()))
+    )
 
 
+# Клавиатуры не меняются после создания — строим каждую один раз и переиспользуем
+@lru_cache(maxsize=None)
 def get_main_menu_kb() -> ReplyKeyboardMarkup:
     """Главное меню (вне семьи)"""
     return ReplyKeyboardMarkup(
@@ -274,6 +657,7 @@ def get_main_menu_kb() -> ReplyKeyboardMarkup:
     )
 
 
+@lru_cache(maxsize=128)
 def get_family_menu_kb(family_name: str) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -288,6 +672,7 @@ def get_family_menu_kb(family_name: str) -> ReplyKeyboardMarkup:
     )
 
 
+@lru_cache(maxsize=None)
 def get_cancel_kb() -> ReplyKeyboardMarkup:
     """Клавиатура отмены для любого состояния FSM"""
     return ReplyKeyboardMarkup(
@@ -297,21 +682,144 @@ def get_cancel_kb() -> ReplyKeyboardMarkup:
     )
 
 
+# Меню настроек семьи — статичное, собирается один раз
+FAM_SETTINGS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✏️ Изменить название", callback_data="fam_settings:name")],
+    [InlineKeyboardButton(text="🔑 Новый ключ приглашения", callback_data="fam_settings:new_key")],
+    [InlineKeyboardButton(text="🏆 Подписка", callback_data="fam_settings:subscription")],
+    [InlineKeyboardButton(text="🗑️ Удалить семью", callback_data="fam_settings:delete")],
+])
+
+
+def build_options_kb(options: Dict[str, Any], prefix: str) -> InlineKeyboardMarkup:
+    """Инлайн-клавиатура выбора из словаря «подпись → значение», по две кнопки в ряд"""
+    builder = InlineKeyboardBuilder()
+    for display, value in options.items():
+        builder.button(text=display, callback_data=f"{prefix}:{value}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+# Общая кнопка возврата к списку задач
+BACK_TO_TASKS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⬅️ К задачам", callback_data="tasks:list")]
+])
+
+TASK_TYPE_KB = build_options_kb(TASK_TYPES, "task_type")
+REMINDER_KB = build_options_kb(REMINDER_OPTIONS, "reminder")
+SHOP_CATEGORY_KB = build_options_kb({
+    "🥛 Продукты питания": "food",
+    "🔧 Автозапчасти": "auto",
+    "🛠️ Хозтовары": "household",
+    "💊 Аптека": "pharmacy",
+    "👕 Одежда/обувь": "clothing",
+    "🎁 Другое": "other"
+}, "shop_cat")
+
+BACK_TO_SETTINGS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⬅️ Назад к настройкам", callback_data="fam_settings:back")]
+])
+DELETE_FAMILY_CONFIRM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Да, удалить", callback_data="fam_settings:delete_confirm")],
+    [InlineKeyboardButton(text="❌ Нет, отмена", callback_data="fam_settings:back")]
+])
+
+
+def shopping_remaining_line(task: Dict[str, Any]) -> str:
+    return f"📦 Осталось купить: {get_unchecked_count(task)} из {len(task['items'])}"
+
+
+def render_shopping_text(task: Dict[str, Any]) -> str:
+    """Текст списка покупок: заголовок, товары с количеством, остаток"""
+    parts = [f"🛒 <b>{task['desc']}</b>\n", f"{HR_LINE}\n"]
+
+    quantities = task.get("quantities", ["1шт"] * len(task["items"]))
+
+    for item, checked, qty in zip(task["items"], task["items_checked"], quantities):
+        mark = "✅" if checked else "🔲"
+        qty_display = f" <code>{qty}</code>" if qty != "1шт" else ""
+        parts.append(f"{mark} {item}{qty_display}\n")
+
+    parts.append(f"{HR_LINE}\n")
+    parts.append(shopping_remaining_line(task))
+    return "".join(parts)
+
+
+@lru_cache(maxsize=256)
+def build_shopping_markup(task_id: str, items: tuple, checked: tuple) -> InlineKeyboardMarkup:
+    """Клавиатура списка покупок — кэшируется по состоянию отметок"""
+    # По одной кнопке в ряд — ряды собираются сразу, без InlineKeyboardBuilder.adjust
+    rows = [
+        [InlineKeyboardButton(text=f"✓ {item[:20]}", callback_data=f"item:check:{task_id}:{idx}")]
+        for idx, (item, is_checked) in enumerate(zip(items, checked))
+        if not is_checked
+    ]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад к задаче", callback_data=f"task:edit:{task_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+BACK_TO_TASK_LIST_BTN = InlineKeyboardButton(text="⬅️ К списку задач", callback_data="tasks:list")
+
+
+@lru_cache(maxsize=1024)
+def build_task_card_kb(task_id: str, is_shopping: bool, progress: int) -> InlineKeyboardMarkup:
+    """Меню действий карточки задачи — зависит только от типа задачи и прогресса"""
+    rows = []
+    if progress < 100 and not is_shopping:
+        # 📈 Быстрая кнопка прогресса (только для не-покупок)
+        quick_pct = min(100, progress + 25)
+        rows.append([InlineKeyboardButton(
+            text=f"⏩ +25% ({quick_pct}%)",
+            callback_data=f"task:quickpct:{task_id}:{quick_pct}"
+        )])
+    if is_shopping:
+        rows.append([InlineKeyboardButton(text="🛒 Показать список", callback_data=f"task:items:{task_id}")])
+    rows.append([InlineKeyboardButton(text="✏️ Изменить прогресс", callback_data=f"task:progress:{task_id}")])
+    if progress < 100:
+        rows.append([InlineKeyboardButton(text="✅ Завершить задачу", callback_data=f"task:complete:{task_id}")])
+    rows.append([BACK_TO_TASK_LIST_BTN])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def edit_if_changed(message: Message, text: str, markup: InlineKeyboardMarkup) -> None:
+    """Редактирует сообщение, только если текст или кнопки изменились"""
+    # Сообщение из callback содержит актуальное состояние — сравниваем с ним.
+    # Telegram обрезает пробелы и переводы строк в конце текста, поэтому сравниваем с text.rstrip().
+    # html_text экранирует &<> в пользовательском тексте, а шаблоны — нет: такие сообщения не совпадут
+    # и уйдут в edit_text, где «not modified» перехватывается ниже
+    if message.reply_markup == markup and message.html_text == text.rstrip():
+        return
+
+    try:
+        await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
 async def notify_family(bot: Bot, fam_id: str, text: str) -> None:
-    """Уведомление всех участников семьи с защитой от флуда"""
+    """Уведомление всех участников семьи — сообщения отправляются параллельно"""
     db = load_db()
-    fam = db["families"].get(fam_id, {})
-    for uid_str in fam.get("members", {}):
-        try:
-            await bot.send_message(
-                int(uid_str),
-                text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_family_menu_kb(fam.get("name", "Семья"))
-            )
-            await asyncio.sleep(0.05)  # Защита от флуда
-        except Exception as e:
-            log_error(f"Notify error for {uid_str}: {e}")
+    fam = db["families"].get(fam_id)
+    if not fam:
+        return
+    members = tuple(get_member_uids(fam))
+    kb = get_family_menu_kb(fam.get("name", "Семья"))  # Одна клавиатура на всю рассылку
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def send_one(chat_id: int) -> None:
+        async with sem:
+            try:
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=kb)
+            except TelegramRetryAfter as e:
+                # Упёрлись в лимит Telegram — ждём, сколько попросили, и повторяем один раз
+                await asyncio.sleep(e.retry_after)
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=kb)
+
+    results = await asyncio.gather(*(send_one(chat_id) for chat_id in members), return_exceptions=True)
+    for chat_id, result in zip(members, results):
+        if isinstance(result, Exception):
+            log_error(f"Notify error for {chat_id}: {result}")
 
 
 async def notify_creator(bot: Bot, fam_id: str, text: str) -> None:
@@ -329,69 +837,91 @@ async def notify_creator(bot: Bot, fam_id: str, text: str) -> None:
 # ────────────────────────────────────────────────
 # Фоновый цикл напоминаний — оптимизирован
 # ────────────────────────────────────────────────
+# Очередь напоминаний: min-heap из (время отправки, fam_id, task_id)
+_reminder_heap: List[tuple] = []
+_REMINDER_WAKE = asyncio.Event()  # Как и _DB_DIRTY, пересоздаётся в start_bot для нового цикла
+REMINDER_MAX_SLEEP = 30  # Не спим дольше — на случай смены часов системы
+
+
+def schedule_reminder(fam_id: str, task_id: str, task: Dict[str, Any]) -> None:
+    """Ставит напоминание задачи в очередь, если оно задано и ещё не отправлено"""
+    reminder_sec = task.get("reminder_sec", 0)
+    if reminder_sec <= 0 or task.get("reminder_sent"):
+        return
+    deadline_ts = get_deadline_ts(task)
+    if deadline_ts == float('inf'):
+        return
+    heapq.heappush(_reminder_heap, (deadline_ts - reminder_sec, fam_id, task_id))
+    _REMINDER_WAKE.set()
+
+
 async def reminders_loop(bot: Bot):
-    """Оптимизированный цикл напоминаний с защитой от отсутствующих дедлайнов"""
+    """Цикл напоминаний: спит до ближайшего напоминания из очереди вместо обхода всех задач"""
+    _reminder_heap.clear()  # При повторном запуске бота очередь строится заново
+    for fam_id, fam in load_db()["families"].items():
+        for task_id, task in fam.get("tasks", {}).items():
+            schedule_reminder(fam_id, task_id, task)
+
     while True:
-        await asyncio.sleep(30)
+        _REMINDER_WAKE.clear()
+        delay = REMINDER_MAX_SLEEP
+        if _reminder_heap:
+            delay = min(delay, max(0.0, _reminder_heap[0][0] - time.time()))
+        try:
+            await asyncio.wait_for(_REMINDER_WAKE.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
         db = load_db()
         now = time.time()
         updated = False
 
-        for fam_id, fam in db["families"].items():
-            for task_id, task in list(fam.get("tasks", {}).items()):
-                # Пропускаем если напоминание уже отправлено
-                if task.get("reminder_sent"):
-                    continue
-
-                # Пропускаем если нет дедлайна ИЛИ дедлайн не строка
-                deadline_str = task.get("deadline")
-                if not deadline_str or not isinstance(deadline_str, str):
-                    continue
-
-                # Пропускаем если нет напоминания
-                reminder_sec = task.get("reminder_sec", 0)
-                if reminder_sec <= 0:
-                    continue
-
-                try:
-                    deadline_dt = datetime.strptime(deadline_str, "%d.%m.%Y %H:%M")
-                    seconds_to_deadline = deadline_dt.timestamp() - now
-
-                    # Отправляем напоминание если время пришло
-                    if 0 < seconds_to_deadline <= reminder_sec:
-                        emoji = "🚨" if seconds_to_deadline < 3600 else "🔔"
-                        text = (
-                            f"{emoji} <b>Напоминание о задаче</b>\n\n"
-                            f"«{task['desc']}»\n"
-                            f"Дедлайн: {format_deadline(deadline_str)}\n\n"
-                            f"Семья: {fam.get('name', 'Семья')}"
-                        )
-                        await notify_family(bot, fam_id, text)
-                        task["reminder_sent"] = True
-                        updated = True
-
-                except ValueError as e:
-                    # Логируем ошибку формата, но не падаем
-                    log_error(f"Reminder format error for task {task_id}: {e}")
-                except Exception as e:
-                    log_error(f"Reminder processing error for task {task_id}: {e}")
+        while _reminder_heap and _reminder_heap[0][0] <= now:
+            _, fam_id, task_id = heapq.heappop(_reminder_heap)
+            fam = db["families"].get(fam_id)
+            task = fam.get("tasks", {}).get(task_id) if fam else None
+            # Задача завершена/удалена или напоминание уже ушло
+            if task is None or task.get("reminder_sent"):
+                continue
+
+            seconds_to_deadline = get_deadline_ts(task) - now
+            if seconds_to_deadline <= 0:
+                continue
 
-        if updated:
             try:
-                atomic_save_db(db)
+                emoji = "🚨" if seconds_to_deadline < 3600 else "🔔"
+                text = (
+                    f"{emoji} <b>Напоминание о задаче</b>\n\n"
+                    f"«{task['desc']}»\n"
+                    f"Дедлайн: {format_deadline(task['deadline'], get_deadline_ts(task))}\n\n"
+                    f"Семья: {fam.get('name', 'Семья')}"
+                )
+                await notify_family(bot, fam_id, text)
+                task["reminder_sent"] = True
+                updated = True
             except Exception as e:
-                log_error(f"Failed to save DB after reminders: {e}")
+                log_error(f"Reminder processing error for task {task_id}: {e}")
+
+        if updated:
+            mark_db_dirty()
 
 
 # ────────────────────────────────────────────────
 # GUI — полностью переработан под 2026 UX
 # ────────────────────────────────────────────────
 class MainWindow(QMainWindow):
+    bot_status = pyqtSignal(str)  # Статус бота, запущенного в цикле qasync
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("🦊 FoxFamilyTask Bot — Настройка (2026)")
         self.resize(800, 600)
 
+        # Запущенный бот: задача в цикле qasync или поток BotThread
+        self.bot_task: Optional[asyncio.Future] = None
+        self.bot_thread: Optional[QThread] = None
+        self.bot_status.connect(self.update_status)  # Один раз — иначе статус дублируется при каждом запуске
+
         # ← УСТАНАВЛИВАЕМ РАБОЧУЮ ДИРЕКТОРИЮ ДО ЗАГРУЗКИ БД
         self.settings = QSettings("FoxFamilyTask", "Bot")
         saved_data = self.settings.value("data_folder")
@@ -403,9 +933,11 @@ class MainWindow(QMainWindow):
         if not saved_data:
             saved_data = self.db.get("data_folder", str(Path.cwd()))
         saved_output = self.settings.value("output_base", self.db.get("output_base", str(Path.cwd() / "output")))
-        self.db["data_folder"] = saved_data
-        self.db["output_base"] = saved_output
-        atomic_save_db(self.db)
+        # Перезаписываем файл БД, только если пути действительно изменились
+        if self.db.get("data_folder") != saved_data or self.db.get("output_base") != saved_output:
+            self.db["data_folder"] = saved_data
+            self.db["output_base"] = saved_output
+            atomic_save_db(self.db)
 
         # Центральный виджет со стеком
         self.stacked = QStackedWidget()
@@ -508,8 +1040,7 @@ class MainWindow(QMainWindow):
             self.token_status.setText("❌ Токен не введён")
             return
 
-        import re
-        if re.match(r"^\d+:[A-Za-z0-9_-]+$", token):
+        if TOKEN_RE.match(token):
             self.token_status.setText("✅ Формат токена корректный")
             self.token_status.setStyleSheet("color: green;")
         else:
@@ -526,6 +1057,7 @@ class MainWindow(QMainWindow):
         try:
             with open(ENV_PATH, "w", encoding="utf-8") as f:
                 f.write(f"TELEGRAM_BOT_TOKEN={token}\n")
+            os.environ["TELEGRAM_BOT_TOKEN"] = token  # Держим окружение процесса в синхроне с .env
             self.token_status.setText("✅ Токен сохранён в .env")
             self.token_status.setStyleSheet("color: green;")
             self.stacked.setCurrentIndex(2)
@@ -582,17 +1114,16 @@ class MainWindow(QMainWindow):
     def save_paths(self) -> None:
         data_path = Path(self.data_edit.text().strip())
         output_path = Path(self.output_edit.text().strip())
-        if not data_path.exists():
-            try:
-                data_path.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                QMessageBox.critical(self, "Ошибка", f"Не удалось создать папку данных: {e}")
-                return
-        if not output_path.exists():
-            try:
-                output_path.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                QMessageBox.warning(self, "Предупреждение", f"Не удалось создать папку вывода: {e}")
+        # mkdir(exist_ok=True) сам проверяет существование — отдельный stat не нужен
+        try:
+            data_path.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось создать папку данных: {e}")
+            return
+        try:
+            output_path.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось создать папку вывода: {e}")
 
         # Сохраняем пути в настройки и БД
         self.settings.setValue("data_folder", str(data_path))
@@ -646,9 +1177,20 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Ошибка", "Токен не найден в .env!")
             return
 
-        self.bot_thread = BotThread(token)
-        self.bot_thread.status_updated.connect(self.update_status)
-        self.bot_thread.start()
+        # Диспетчер общий на модуль — второй polling параллельно с первым запустить нельзя
+        if (self.bot_task is not None and not self.bot_task.done()) or (
+            self.bot_thread is not None and self.bot_thread.isRunning()
+        ):
+            QMessageBox.information(self, "Бот уже запущен", "Бот уже работает — повторный запуск не нужен.")
+            return
+
+        if qasync is not None:
+            # Бот работает в том же цикле, что и GUI — без потока и межпоточных сигналов
+            self.bot_task = asyncio.ensure_future(run_bot(token, self.bot_status))
+        else:
+            self.bot_thread = BotThread(token)
+            self.bot_thread.status_updated.connect(self.update_status)
+            self.bot_thread.start()
         self.status_label.setText("🔄 Бот запускается...")
         log_info("Bot launch initiated via GUI")
 
@@ -674,479 +1216,546 @@ class BotThread(QThread):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            self.status_updated.emit("Инициализация бота...")
-            loop.run_until_complete(start_bot(self.token, self.status_updated))
-        except Exception as e:
-            log_error(f"BotThread fatal error: {e}")
-            self.status_updated.emit(f"❌ Критическая ошибка: {str(e)}")
+            loop.run_until_complete(run_bot(self.token, self.status_updated))
         finally:
             loop.close()
 
 
+async def run_bot(token: str, status_signal: pyqtSignal) -> None:
+    """Запуск бота в текущем цикле событий с выводом статуса в GUI"""
+    try:
+        status_signal.emit("Инициализация бота...")
+        await start_bot(token, status_signal)
+    except Exception as e:
+        log_error(f"Bot fatal error: {e}")
+        status_signal.emit(f"❌ Критическая ошибка: {str(e)}")
+
+
 # ────────────────────────────────────────────────
 # Telegram Bot Logic — полностью переработанная архитектура диалогов
 # ────────────────────────────────────────────────
-async def start_bot(token: str, status_signal: pyqtSignal) -> None:
-    bot = Bot(token=token)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-
-    status_signal.emit("Бот запущен. Ожидание команд...")
+router = Router()
 
-    # ─── ГЛОБАЛЬНЫЕ КОМАНДЫ ────────────────────────────────────────────
-    @dp.message(Command("start"))
-    async def cmd_start(message: Message, state: FSMContext) -> None:
-        await state.clear()
-        db = load_db()
-        uid = str(message.from_user.id)
 
-        # Инициализация пользователя если новый
-        if uid not in db["users"]:
-            db["users"][uid] = {
-                "families": [],
-                "current_family": "",
-                "settings": {"timezone": "UTC", "timezone_offset": 0}  # ← ДОБАВИТЬ
-            }
-            atomic_save_db(db)
-
-        user = db["users"][uid]
-        current_fam_id = user["current_family"]
-
-        if current_fam_id and current_fam_id in db["families"]:
-            # Пользователь внутри семьи — показываем меню семьи
-            fam = db["families"][current_fam_id]
-            await message.answer(
-                f"🦊 Добро пожаловать в семью «{fam['name']}»!",
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-        else:
-            # Пользователь вне семьи — главное меню
-            await message.answer(
-                "🏠 <b>Главное меню</b>\n\n"
-                "Выберите действие для управления семьями:",
-                reply_markup=get_main_menu_kb(),
-                parse_mode=ParseMode.HTML
-            )
+# ─── ГЛОБАЛЬНЫЕ КОМАНДЫ ────────────────────────────────────────────
+@router.message(Command("start"))
+async def cmd_start(message: Message, state: FSMContext, db: Dict[str, Any], uid: str) -> None:
+    await state.clear()
 
-    @dp.message(Command("cancel"))
-    @dp.message(F.text == "❌ Отмена")
-    async def cmd_cancel(message: Message, state: FSMContext) -> None:
-        current_state = await state.get_state()
-        if current_state is None:
-            await message.answer("Нет активных операций для отмены.", reply_markup=ReplyKeyboardRemove())
-            return
+    # Инициализация пользователя если новый — один поиск и для проверки, и для чтения
+    user = db["users"].get(uid)
+    if user is None:
+        user = db["users"][uid] = {
+            "families": [],
+            "current_family": "",
+            "settings": {"timezone": "UTC", "timezone_offset": 0}  # ← ДОБАВИТЬ
+        }
+        mark_db_dirty()
 
-        await state.clear()
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].get(uid, {})
-        current_fam_id = user.get("current_family")
+    current_fam_id = user["current_family"]
+    fam = db["families"].get(current_fam_id) if current_fam_id else None
 
-        if current_fam_id and current_fam_id in db["families"]:
-            fam = db["families"][current_fam_id]
-            await message.answer(
-                "❌ Операция отменена. Возврат в меню семьи.",
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-        else:
-            await message.answer(
-                "❌ Операция отменена. Возврат в главное меню.",
-                reply_markup=get_main_menu_kb()
-            )
+    if fam is not None:
+        # Пользователь внутри семьи — показываем меню семьи
+        await message.answer(
+            f"🦊 Добро пожаловать в семью «{fam['name']}»!",
+            reply_markup=get_family_menu_kb(fam["name"])
+        )
+    else:
+        # Пользователь вне семьи — главное меню
+        await message.answer(
+            "🏠 <b>Главное меню</b>\n\n"
+            "Выберите действие для управления семьями:",
+            reply_markup=get_main_menu_kb(),
+            parse_mode=ParseMode.HTML
+        )
 
-    # ─── ГЛАВНОЕ МЕНЮ (вне семьи) ───────────────────────────────────────
-    @dp.message(F.text == "📋 Мои семьи")
-    async def my_families(message: Message, state: FSMContext) -> None:
-        await state.clear()
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].get(uid, {"families": []})
 
-        if not user["families"]:
-            await message.answer(
-                "📭 У вас пока нет семей.\n"
-                "Создайте новую или присоединитесь по ключу!",
-                reply_markup=get_main_menu_kb()
-            )
-            return
+@router.message(Command("cancel"))
+@router.message(F.text == "❌ Отмена")
+async def cmd_cancel(message: Message, state: FSMContext) -> None:
+    # Вызывается и напрямую из других хендлеров — поэтому без db/uid из middleware
+    current_state = await state.get_state()
+    if current_state is None:
+        await message.answer("Нет активных операций для отмены.", reply_markup=ReplyKeyboardRemove())
+        return
 
-        # Формируем список семей
-        text = "🏠 <b>Ваши семьи:</b>\n\n"
-        builder = InlineKeyboardBuilder()
+    await state.clear()
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].get(uid, {})
+    current_fam_id = user.get("current_family")
 
-        for idx, fam_id in enumerate(user["families"], 1):
-            fam = db["families"].get(fam_id, {})
-            name = fam.get("name", "Без названия")
-            members_count = len(fam.get("members", {}))
-            is_current = fam_id == user.get("current_family")
+    if current_fam_id and current_fam_id in db["families"]:
+        fam = db["families"][current_fam_id]
+        await message.answer(
+            "❌ Операция отменена. Возврат в меню семьи.",
+            reply_markup=get_family_menu_kb(fam["name"])
+        )
+    else:
+        await message.answer(
+            "❌ Операция отменена. Возврат в главное меню.",
+            reply_markup=get_main_menu_kb()
+        )
 
-            prefix = "✅ " if is_current else f"{idx}. "
-            text += f"{prefix}{name} ({members_count} участников)\n"
-            builder.button(text=f"→ {name}", callback_data=f"enter_family:{fam_id}")
 
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="➕ Создать новую", callback_data="create_family"))
+# ─── ГЛАВНОЕ МЕНЮ (вне семьи) ───────────────────────────────────────
+@router.message(F.text == "📋 Мои семьи")
+async def my_families(message: Message, state: FSMContext, db: Dict[str, Any], uid: str) -> None:
+    await state.clear()
+    user = db["users"].get(uid, {"families": []})
 
+    if not user["families"]:
         await message.answer(
-            text,
-            reply_markup=builder.as_markup(),
-            parse_mode=ParseMode.HTML
+            "📭 У вас пока нет семей.\n"
+            "Создайте новую или присоединитесь по ключу!",
+            reply_markup=get_main_menu_kb()
         )
+        return
+
+    # Формируем список семей
+    parts = ["🏠 <b>Ваши семьи:</b>\n\n"]
+    rows = []
+
+    families = db["families"]
+    current_fam_id = user.get("current_family")
+    for idx, fam_id in enumerate(user["families"], 1):
+        fam = families.get(fam_id, {})
+        name = fam.get("name", "Без названия")
+        members_count = len(fam["members"]) if "members" in fam else 0
+        is_current = fam_id == current_fam_id
+
+        prefix = "✅ " if is_current else f"{idx}. "
+        parts.append(f"{prefix}{name} ({members_count} участников)\n")
+        rows.append([InlineKeyboardButton(text=f"→ {name}", callback_data=f"enter_family:{fam_id}")])
+
+    rows.append([InlineKeyboardButton(text="➕ Создать новую", callback_data="create_family")])
+
+    await message.answer(
+        "".join(parts),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows),
+        parse_mode=ParseMode.HTML
+    )
 
-    @dp.callback_query(F.data.startswith("enter_family:"))
-    async def enter_family(cq: CallbackQuery, state: FSMContext) -> None:
-        fam_id = cq.data.split(":")[1]
-        db = load_db()
-        uid = str(cq.from_user.id)
-        user = db["users"].get(uid, {})
 
-        if fam_id not in user.get("families", []):
-            await cq.answer("❌ Вы не состоите в этой семье!", show_alert=True)
-            return
+@router.callback_query(F.data.startswith(CB_ENTER_FAMILY))
+async def enter_family(cq: CallbackQuery, state: FSMContext, db: Dict[str, Any], uid: str) -> None:
+    fam_id = cq.data[len(CB_ENTER_FAMILY):]
+    user = db["users"].get(uid, {})
 
-        # Переключаем текущую семью
-        user["current_family"] = fam_id
-        atomic_save_db(db)
+    if fam_id not in user.get("families", []):
+        await cq.answer("❌ Вы не состоите в этой семье!", show_alert=True)
+        return
 
-        fam = db["families"][fam_id]
-        await cq.message.edit_text(
-            f"✅ Вы вошли в семью «{fam['name']}»",
-            reply_markup=None
-        )
-        await cq.message.answer(
-            f"🏡 <b>{fam['name']}</b>\n\n"
-            f"Участников: {len(fam['members'])}\n"
-            f"Активных задач: {len(fam.get('tasks', {}))}",
-            reply_markup=get_family_menu_kb(fam["name"]),
-            parse_mode=ParseMode.HTML
-        )
-        await cq.answer()
+    # Переключаем текущую семью
+    user["current_family"] = fam_id
+    mark_db_dirty()
 
-    @dp.callback_query(F.data == "create_family")
-    async def create_family_callback(cq: CallbackQuery, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(cq.from_user.id)
-
-        # Создаём новую семью
-        fam_id = str(uuid.uuid4())
-        key_data = generate_family_key()
-        db["families"][fam_id] = {
-            "name": "🦊 Моя семья",
-            "created_at": time.time(),
-            "creator_id": uid,
-            "members": {uid: {"nick": cq.from_user.first_name or "Участник", "joined": time.time()}},
-            "active_key": key_data,
-            "tasks": {},
-            "completed_tasks": {},
-        }
+    fam = db["families"][fam_id]
+    await cq.message.edit_text(
+        f"✅ Вы вошли в семью «{fam['name']}»",
+        reply_markup=None
+    )
+    await cq.message.answer(
+        f"🏡 <b>{fam['name']}</b>\n\n"
+        f"Участников: {len(fam['members'])}\n"
+        f"Активных задач: {len(fam.get('tasks', {}))}",
+        reply_markup=get_family_menu_kb(fam["name"]),
+        parse_mode=ParseMode.HTML
+    )
+    await cq.answer()
+
+
+@router.callback_query(F.data == "create_family")
+async def create_family_callback(cq: CallbackQuery, state: FSMContext, db: Dict[str, Any], uid: str) -> None:
+    # Создаём новую семью
+    fam_id = str(uuid.uuid4())
+    key_data = generate_family_key()
+    db["families"][fam_id] = {
+        "name": "🦊 Моя семья",
+        "created_at": time.time(),
+        "creator_id": uid,
+        "members": {uid: {"nick": cq.from_user.first_name or "Участник", "joined": time.time()}},
+        "_member_uids": [int(uid)],
+        "active_key": None,
+        "tasks": {},
+        "completed_tasks": {},
+    }
+    set_family_key(db, fam_id, key_data)
+
+    # Добавляем семью пользователю
+    user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
+    user["families"].append(fam_id)
+    user["current_family"] = fam_id
+
+    mark_db_dirty()
+
+    # Отправляем приглашение
+    await cq.message.edit_text(
+        f"✅ Семья «{db['families'][fam_id]['name']}» создана!\n\n"
+        f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
+        f"<code>{key_data['value']}</code>\n\n"
+        "Поделитесь этим ключом с членами семьи!",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(db['families'][fam_id]['name'])
+    )
+    await cq.answer("Семья создана!")
+
+
+@router.message(F.text == "➕ Создать семью")
+async def create_family_handler(message: Message, state: FSMContext, db: Dict[str, Any], uid: str) -> None:
+    # Создаём новую семью
+    fam_id = str(uuid.uuid4())
+    key_data = generate_family_key()
+    db["families"][fam_id] = {
+        "name": "🦊 Моя семья",
+        "created_at": time.time(),
+        "creator_id": uid,
+        "members": {uid: {"nick": "Создатель", "joined": time.time()}},  # Временный ник
+        "_member_uids": [int(uid)],
+        "active_key": None,
+        "tasks": {},
+        "completed_tasks": {},
+    }
+    set_family_key(db, fam_id, key_data)
 
-        # Добавляем семью пользователю
-        user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
-        user["families"].append(fam_id)
-        user["current_family"] = fam_id
+    # Добавляем семью пользователю
+    user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
+    user["families"].append(fam_id)
+    user["current_family"] = fam_id
 
-        atomic_save_db(db)
+    mark_db_dirty()
 
-        # Отправляем приглашение
-        await cq.message.edit_text(
-            f"✅ Семья «{db['families'][fam_id]['name']}» создана!\n\n"
-            f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
-            f"<code>{key_data['value']}</code>\n\n"
-            "Поделитесь этим ключом с членами семьи!",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(db['families'][fam_id]['name'])
-        )
-        await cq.answer("Семья создана!")
+    # Запрашиваем ник создателя
+    await state.set_state(FamilyStates.set_creator_nick)
+    await state.update_data(fam_id=fam_id, creator_id=uid)
+    await message.answer(
+        "✏️ Введите ваш никнейм в семье (до 32 символов):",
+        reply_markup=get_cancel_kb()
+    )
 
-    @dp.message(F.text == "➕ Создать семью")
-    async def create_family_handler(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
+    # Отправляем приглашение
+    await message.answer(
+        f"✅ Семья «{db['families'][fam_id]['name']}» создана!\n\n"
+        f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
+        f"<code>{key_data['value']}</code>\n\n"
+        "Поделитесь этим ключом с членами семьи!",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(db['families'][fam_id]['name'])
+    )
 
-        # Создаём новую семью
-        fam_id = str(uuid.uuid4())
-        key_data = generate_family_key()
-        db["families"][fam_id] = {
-            "name": "🦊 Моя семья",
-            "created_at": time.time(),
-            "creator_id": uid,
-            "members": {uid: {"nick": "Создатель", "joined": time.time()}},  # Временный ник
-            "active_key": key_data,
-            "tasks": {},
-            "completed_tasks": {},
-        }
 
-        # Добавляем семью пользователю
-        user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
-        user["families"].append(fam_id)
-        user["current_family"] = fam_id
+@router.message(FamilyStates.set_creator_nick)
+async def set_creator_nick_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-        atomic_save_db(db)
+    nick = message.text.strip()[:32]
+    if not nick:
+        await message.answer("❌ Ник не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
+        return
 
-        # Запрашиваем ник создателя
-        await state.set_state(FamilyStates.set_creator_nick)
-        await state.update_data(fam_id=fam_id, creator_id=uid)
-        await message.answer(
-            "✏️ Введите ваш никнейм в семье (до 32 символов):",
-            reply_markup=get_cancel_kb()
-        )
+    data = await state.get_data()
+    fam_id = data.get("fam_id")
+    if not fam_id:
+        await message.answer("❌ Ошибка состояния. Возврат в главное меню.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
 
-        # Отправляем приглашение
-        await message.answer(
-            f"✅ Семья «{db['families'][fam_id]['name']}» создана!\n\n"
-            f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
-            f"<code>{key_data['value']}</code>\n\n"
-            "Поделитесь этим ключом с членами семьи!",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(db['families'][fam_id]['name'])
-        )
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam = db["families"].get(fam_id)
+    if not fam or fam.get("creator_id") != uid:  # ← ДОБАВИТЬ ПРОВЕРКУ
+        await message.answer("❌ Ошибка: вы не создатель семьи!",
+                             reply_markup=get_family_menu_kb(fam.get("name", "Семья")))
+        await state.clear()
+        return
+    if not fam or uid not in fam["members"]:
+        await message.answer("❌ Ошибка семьи. Возврат в главное меню.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
+
+    # Обновляем ник
+    fam["members"][uid]["nick"] = nick
+    mark_db_dirty()
+
+    # Отправляем приглашение с ключом
+    await message.answer(
+        f"✅ Семья «{fam['name']}» создана!\n"
+        f"Ваш ник: <b>{nick}</b>\n\n"
+        f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
+        f"<code>{fam['active_key']['value']}</code>\n\n"
+        "Поделитесь этим ключом с членами семьи!",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
+    await state.clear()
 
-    @dp.message(FamilyStates.set_creator_nick)
-    async def set_creator_nick_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
 
-        nick = message.text.strip()[:32]
-        if not nick:
-            await message.answer("❌ Ник не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
-            return
+@router.message(F.text == "➕ Новая задача")
+async def new_task_from_menu(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье! Возврат в главное меню.", reply_markup=get_main_menu_kb())
+        return
+
+    # Начинаем создание задачи
+    await message.answer(
+        "📝 <b>Выберите тип задачи:</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=TASK_TYPE_KB
+    )
+    await state.set_state(FamilyStates.create_task_type)
 
-        data = await state.get_data()
-        fam_id = data.get("fam_id")
-        if not fam_id:
-            await message.answer("❌ Ошибка состояния. Возврат в главное меню.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
 
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam = db["families"].get(fam_id)
-        if not fam or fam.get("creator_id") != uid:  # ← ДОБАВИТЬ ПРОВЕРКУ
-            await message.answer("❌ Ошибка: вы не создатель семьи!",
-                                 reply_markup=get_family_menu_kb(fam.get("name", "Семья")))
-            await state.clear()
-            return
-        if not fam or uid not in fam["members"]:
-            await message.answer("❌ Ошибка семьи. Возврат в главное меню.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
+@router.message(F.text == "🔑 Присоединиться")
+async def join_family(message: Message, state: FSMContext) -> None:
+    await state.set_state(GlobalStates.join_key)
+    await message.answer(
+        "🔑 Введите ключ приглашения для присоединения к семье:",
+        reply_markup=get_cancel_kb()
+    )
 
-        # Обновляем ник
-        fam["members"][uid]["nick"] = nick
-        atomic_save_db(db)
 
-        # Отправляем приглашение с ключом
+@router.message(GlobalStates.join_key)
+async def join_key_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
+
+    key_input = message.text.strip()
+    db = load_db()
+    uid = str(message.from_user.id)
+    found_family = None
+
+    # Поиск семьи по ключу — через индекс, без обхода всех семей
+    key_index = get_key_index(db)
+    fam_id = key_index.get(key_input)
+    fam = db["families"].get(fam_id) if fam_id else None
+    if fam is not None and is_key_valid(key_input, fam):
+        found_family = fam_id
+    elif fam_id and (fam is None or not fam.get("active_key")):
+        key_index.pop(key_input, None)  # Семья удалена или ключ истёк
+
+    if not found_family:
         await message.answer(
-            f"✅ Семья «{fam['name']}» создана!\n"
-            f"Ваш ник: <b>{nick}</b>\n\n"
-            f"🔑 <b>Ключ приглашения</b> (действует 10 минут):\n"
-            f"<code>{fam['active_key']['value']}</code>\n\n"
-            "Поделитесь этим ключом с членами семьи!",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(fam["name"])
+            "❌ Неверный или истёкший ключ.\nПопробуйте снова или запросите новый у создателя семьи.",
+            reply_markup=get_cancel_kb()
+        )
+        return
+
+    # Проверка лимита участников
+    fam = db["families"][found_family]
+    if len(fam["members"]) >= MAX_FREE_MEMBERS and fam.get("subscription") is None:
+        await message.answer(
+            f"🚫 Семья достигла лимита ({MAX_FREE_MEMBERS} участников).\n"
+            "Для увеличения лимита требуется подписка.",
+            reply_markup=get_main_menu_kb()
         )
         await state.clear()
+        return
 
-    @dp.message(F.text == "➕ Новая задача")
-    async def new_task_from_menu(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    if len(fam["members"]) >= WARN_MEMBERS_THRESHOLD:
+        await message.answer(
+            f"⚠️ В семье уже {len(fam['members'])} участников.\n"
+            f"Бесплатный лимит: {MAX_FREE_MEMBERS} человек."
+        )
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье! Возврат в главное меню.", reply_markup=get_main_menu_kb())
-            return
+    # Проверка уникальности ника
+    base_nick = message.from_user.first_name or "Участник"
+    nick = base_nick
+    taken = {m["nick"] for m in fam["members"].values()}  # Один проход по участникам на весь подбор
+    if nick in taken:
+        # Перебор суффиксов продолжаем с последнего предложенного, а не с _1
+        counters = fam.setdefault("_nick_counters", {})
+        counter = counters.get(base_nick, 1)
+        while f"{base_nick}_{counter}" in taken:
+            counter += 1
+        nick = f"{base_nick}_{counter}"
+        if counters.get(base_nick) != counter:
+            counters[base_nick] = counter
+            mark_db_dirty()  # Счётчик хранится в БД — переживает перезапуск
+
+    # Сохраняем данные для следующего шага
+    await state.update_data(fam_id=found_family, suggested_nick=nick)
+    await state.set_state(GlobalStates.join_nick)
+    await message.answer(
+        f"✏️ Введите ваш никнейм в семье:\n"
+        f"(предложено: <code>{nick}</code>)",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
 
-        # Начинаем создание задачи
-        builder = InlineKeyboardBuilder()
-        for display, value in TASK_TYPES.items():
-            builder.button(text=display, callback_data=f"task_type:{value}")
-        builder.adjust(2)
 
-        await message.answer(
-            "📝 <b>Выберите тип задачи:</b>",
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-        await state.set_state(FamilyStates.create_task_type)
+@router.message(GlobalStates.join_nick)
+async def join_nick_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
+
+    nick = message.text.strip()[:32]  # Ограничение длины
+    if not nick:
+        await message.answer("❌ Никнейм не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
+        return
+
+    data = await state.get_data()
+    fam_id = data.get("fam_id")
+    if not fam_id:
+        await message.answer("❌ Ошибка состояния. Начните заново.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
 
-    @dp.message(F.text == "🔑 Присоединиться")
-    async def join_family(message: Message, state: FSMContext) -> None:
-        await state.set_state(GlobalStates.join_key)
+    db = load_db()
+    fam = db["families"].get(fam_id)
+    if not fam:
+        await message.answer("❌ Семья не найдена. Ключ мог истечь.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
+
+    # Проверка уникальности ника
+    if any(m["nick"] == nick for m in fam["members"].values()):
         await message.answer(
-            "🔑 Введите ключ приглашения для присоединения к семье:",
+            f"❌ Ник «{nick}» уже занят. Выберите другой:",
             reply_markup=get_cancel_kb()
         )
+        return
 
-    @dp.message(GlobalStates.join_key)
-    async def join_key_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
+    uid = str(message.from_user.id)
+    add_member(fam, uid, {"nick": nick, "joined": time.time()})
 
-        key_input = message.text.strip()
-        db = load_db()
-        uid = str(message.from_user.id)
-        found_family = None
+    # Добавляем семью пользователю
+    user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
+    if fam_id not in user["families"]:
+        user["families"].append(fam_id)
+    user["current_family"] = fam_id
 
-        # Поиск семьи по ключу
-        for fam_id, fam in db["families"].items():
-            if is_key_valid(key_input, fam):
-                found_family = fam_id
-                break
+    # Генерируем новый ключ для будущих приглашений
+    set_family_key(db, fam_id, generate_family_key())
+    mark_db_dirty()
 
-        if not found_family:
-            await message.answer(
-                "❌ Неверный или истёкший ключ.\nПопробуйте снова или запросите новый у создателя семьи.",
-                reply_markup=get_cancel_kb()
-            )
-            return
-
-        # Проверка лимита участников
-        fam = db["families"][found_family]
-        if len(fam["members"]) >= MAX_FREE_MEMBERS and fam.get("subscription") is None:
-            await message.answer(
-                f"🚫 Семья достигла лимита ({MAX_FREE_MEMBERS} участников).\n"
-                "Для увеличения лимита требуется подписка.",
-                reply_markup=get_main_menu_kb()
-            )
-            await state.clear()
-            return
-
-        if len(fam["members"]) >= WARN_MEMBERS_THRESHOLD:
-            await message.answer(
-                f"⚠️ В семье уже {len(fam['members'])} участников.\n"
-                f"Бесплатный лимит: {MAX_FREE_MEMBERS} человек."
-            )
-
-        # Проверка уникальности ника
-        base_nick = message.from_user.first_name or "Участник"
-        nick = base_nick
-        counter = 1
-        while any(m["nick"] == nick for m in fam["members"].values()):
-            nick = f"{base_nick}_{counter}"
-            counter += 1
-
-        # Сохраняем данные для следующего шага
-        await state.update_data(fam_id=found_family, suggested_nick=nick)
-        await state.set_state(GlobalStates.join_nick)
-        await message.answer(
-            f"✏️ Введите ваш никнейм в семье:\n"
-            f"(предложено: <code>{nick}</code>)",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_cancel_kb()
-        )
-
-    @dp.message(GlobalStates.join_nick)
-    async def join_nick_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
-
-        nick = message.text.strip()[:32]  # Ограничение длины
-        if not nick:
-            await message.answer("❌ Никнейм не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
-            return
-
-        data = await state.get_data()
-        fam_id = data.get("fam_id")
-        if not fam_id:
-            await message.answer("❌ Ошибка состояния. Начните заново.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
+    # Уведомляем семью
+    await notify_family(
+        message.bot,
+        fam_id,
+        f"🎉 <b>{nick}</b> присоединился к семье «{fam['name']}»!"
+    )
 
-        db = load_db()
-        fam = db["families"].get(fam_id)
-        if not fam:
-            await message.answer("❌ Семья не найдена. Ключ мог истечь.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
+    await message.answer(
+        f"✅ Добро пожаловать в семью «{fam['name']}»!\n\n"
+        f"Ваш ник: <b>{nick}</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
+    await state.clear()
 
-        # Проверка уникальности ника
-        if any(m["nick"] == nick for m in fam["members"].values()):
-            await message.answer(
-                f"❌ Ник «{nick}» уже занят. Выберите другой:",
-                reply_markup=get_cancel_kb()
-            )
-            return
 
-        uid = str(message.from_user.id)
-        fam["members"][uid] = {"nick": nick, "joined": time.time()}
+@router.message(F.text == "⚙️ Настройки")
+async def global_settings(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].get(uid, {})
+    tz_offset = user.get("settings", {}).get("timezone_offset", 0)
+    sign = "+" if tz_offset >= 0 else ""
+    text = (
+        "⚙️ <b>Настройки</b>\n"
+        f"Ваш часовой пояс: <code>UTC{sign}{tz_offset}</code>\n"
+        "Серверное время: <code>UTC+3 (МСК)</code>\n\n"
+        "ℹ️ Для корректного отображения дедлайнов установите свой часовой пояс в главном меню."
+    )
+    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_main_menu_kb())
 
-        # Добавляем семью пользователю
-        user = db["users"].setdefault(uid, {"families": [], "current_family": "", "settings": {"timezone": "UTC"}})
-        if fam_id not in user["families"]:
-            user["families"].append(fam_id)
-        user["current_family"] = fam_id
 
-        # Генерируем новый ключ для будущих приглашений
-        fam["active_key"] = generate_family_key()
-        atomic_save_db(db)
+@router.message(F.text == "⏰ Мой часовой пояс")
+async def set_timezone(message: Message, state: FSMContext) -> None:
+    # Корректное время сервера (МСК = UTC+3)
+    server_time_utc = datetime.now(timezone.utc)
+    server_time_msk = server_time_utc + timedelta(hours=3)
+    server_time_str = server_time_msk.strftime("%H:%M")
 
-        # Уведомляем семью
-        await notify_family(
-            message.bot,
-            fam_id,
-            f"🎉 <b>{nick}</b> присоединился к семье «{fam['name']}»!"
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].setdefault(uid, {
+        "families": [],
+        "current_family": "",
+        "settings": {"timezone_offset": 0}
+    })
+    current_offset = user["settings"].get("timezone_offset", 0)
+    sign = "+" if current_offset >= 0 else ""
+
+    # Расчёт пользовательского времени
+    user_time = server_time_utc + timedelta(hours=current_offset)
+    user_time_str = user_time.strftime("%H:%M")
+
+    await state.set_state(GlobalStates.settings_timezone)
+    await message.answer(
+        f"⏰ <b>Ваш часовой пояс</b>\n\n"
+        f"🌍 Сервер (МСК): <b>{server_time_str}</b> (UTC+3)\n"
+        f"📱 Ваш часовой пояс: <code>UTC{sign}{current_offset}</code>\n"
+        f"⏰ Ваше время: <b>{user_time_str}</b>\n\n"
+        f"🕗 <b>Выберите новый часовой пояс:</b>\n"
+        f"• 🇷🇺 <code>+3</code> — Москва, Минск, Стамбул\n"
+        f"• 🇺🇦 <code>+2</code> — Киев, Варшава, Берлин\n"
+        f"• 🇬🇧 <code>0</code> — Лондон, Лиссабон, Рейкьявик\n"
+        f"• 🇺🇸 <code>-5</code> — Нью-Йорк, Торонто, Богота\n\n"
+        f"💡 Или введите число от <code>-12</code> до <code>+14</code>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="🕗 +3 (Москва, Минск)")],
+                [KeyboardButton(text="🕗 +2 (Киев, Варшава)")],
+                [KeyboardButton(text="🕗 0 (Лондон)")],
+                [KeyboardButton(text="🕗 -5 (Нью-Йорк)")],
+                [KeyboardButton(text="❌ Отмена")],
+            ],
+            resize_keyboard=True,
+            input_field_placeholder="Введите +3, -5 или выберите из списка..."
         )
+    )
 
-        await message.answer(
-            f"✅ Добро пожаловать в семью «{fam['name']}»!\n\n"
-            f"Ваш ник: <b>{nick}</b>",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(fam["name"])
-        )
-        await state.clear()
 
-    @dp.message(F.text == "⚙️ Настройки")
-    async def global_settings(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].get(uid, {})
-        tz_offset = user.get("settings", {}).get("timezone_offset", 0)
-        sign = "+" if tz_offset >= 0 else ""
-        text = (
-            "⚙️ <b>Настройки</b>\n"
-            f"Ваш часовой пояс: <code>UTC{sign}{tz_offset}</code>\n"
-            "Серверное время: <code>UTC+3 (МСК)</code>\n\n"
-            "ℹ️ Для корректного отображения дедлайнов установите свой часовой пояс в главном меню."
-        )
-        await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_main_menu_kb())
+@router.message(GlobalStates.settings_timezone)
+async def set_timezone_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-    @dp.message(F.text == "⏰ Мой часовой пояс")
-    async def set_timezone(message: Message, state: FSMContext) -> None:
-        # Корректное время сервера (МСК = UTC+3)
-        server_time_utc = datetime.now(timezone.utc)
-        server_time_msk = server_time_utc + timedelta(hours=3)
-        server_time_str = server_time_msk.strftime("%H:%M")
+    text = message.text.strip()
 
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].setdefault(uid, {
-            "families": [],
-            "current_family": "",
-            "settings": {"timezone_offset": 0}
-        })
-        current_offset = user["settings"].get("timezone_offset", 0)
-        sign = "+" if current_offset >= 0 else ""
+    # 🌐 Умный парсинг часового пояса
+    offset = None
+    import re
+
+    # Случай 1: Чистое число "+3", "-5", "0"
+    match = re.search(r'^([+-]?\d+)$', text.replace(" ", ""))
+    if match:
+        try:
+            offset = int(match.group(1))
+        except:
+            pass
 
-        # Расчёт пользовательского времени
-        user_time = server_time_utc + timedelta(hours=current_offset)
-        user_time_str = user_time.strftime("%H:%M")
+    # Случай 2: Текст с числом "+3 (Москва)"
+    if offset is None:
+        match = re.search(r'([+-]\d+|\b\d+\b)', text.replace(" ", ""))
+        if match:
+            try:
+                offset = int(match.group(1).replace("+", "").replace("−", "-"))
+            except:
+                pass
 
-        await state.set_state(GlobalStates.settings_timezone)
+    # 🚨 Валидация
+    if offset is None:
         await message.answer(
-            f"⏰ <b>Ваш часовой пояс</b>\n\n"
-            f"🌍 Сервер (МСК): <b>{server_time_str}</b> (UTC+3)\n"
-            f"📱 Ваш часовой пояс: <code>UTC{sign}{current_offset}</code>\n"
-            f"⏰ Ваше время: <b>{user_time_str}</b>\n\n"
-            f"🕗 <b>Выберите новый часовой пояс:</b>\n"
-            f"• 🇷🇺 <code>+3</code> — Москва, Минск, Стамбул\n"
-            f"• 🇺🇦 <code>+2</code> — Киев, Варшава, Берлин\n"
-            f"• 🇬🇧 <code>0</code> — Лондон, Лиссабон, Рейкьявик\n"
-            f"• 🇺🇸 <code>-5</code> — Нью-Йорк, Торонто, Богота\n\n"
-            f"💡 Или введите число от <code>-12</code> до <code>+14</code>",
+            "🤔 <b>Не распознал часовой пояс</b>\n\n"
+            "Пожалуйста, укажите смещение от UTC:\n"
+            "✅ <code>+3</code> — для Москвы/Минска\n"
+            "✅ <code>+2</code> — для Киева/Варшавы\n"
+            "✅ <code>0</code> — для Лондона\n"
+            "✅ <code>-5</code> — для Нью-Йорка\n\n"
+            "💡 Просто нажмите на кнопку ниже — это быстрее!",
             parse_mode=ParseMode.HTML,
             reply_markup=ReplyKeyboardMarkup(
                 keyboard=[
@@ -1157,1637 +1766,1553 @@ async def start_bot(token: str, status_signal: pyqtSignal) -> None:
                     [KeyboardButton(text="❌ Отмена")],
                 ],
                 resize_keyboard=True,
-                input_field_placeholder="Введите +3, -5 или выберите из списка..."
+                input_field_placeholder="Введите +3, -5 или выберите кнопку..."
             )
         )
+        return
 
-    @dp.message(GlobalStates.settings_timezone)
-    async def set_timezone_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
-
-        text = message.text.strip()
-
-        # 🌐 Умный парсинг часового пояса
-        offset = None
-        import re
-
-        # Случай 1: Чистое число "+3", "-5", "0"
-        match = re.search(r'^([+-]?\d+)$', text.replace(" ", ""))
-        if match:
-            try:
-                offset = int(match.group(1))
-            except:
-                pass
-
-        # Случай 2: Текст с числом "+3 (Москва)"
-        if offset is None:
-            match = re.search(r'([+-]\d+|\b\d+\b)', text.replace(" ", ""))
-            if match:
-                try:
-                    offset = int(match.group(1).replace("+", "").replace("−", "-"))
-                except:
-                    pass
-
-        # 🚨 Валидация
-        if offset is None:
-            await message.answer(
-                "🤔 <b>Не распознал часовой пояс</b>\n\n"
-                "Пожалуйста, укажите смещение от UTC:\n"
-                "✅ <code>+3</code> — для Москвы/Минска\n"
-                "✅ <code>+2</code> — для Киева/Варшавы\n"
-                "✅ <code>0</code> — для Лондона\n"
-                "✅ <code>-5</code> — для Нью-Йорка\n\n"
-                "💡 Просто нажмите на кнопку ниже — это быстрее!",
-                parse_mode=ParseMode.HTML,
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text="🕗 +3 (Москва, Минск)")],
-                        [KeyboardButton(text="🕗 +2 (Киев, Варшава)")],
-                        [KeyboardButton(text="🕗 0 (Лондон)")],
-                        [KeyboardButton(text="🕗 -5 (Нью-Йорк)")],
-                        [KeyboardButton(text="❌ Отмена")],
-                    ],
-                    resize_keyboard=True,
-                    input_field_placeholder="Введите +3, -5 или выберите кнопку..."
-                )
-            )
-            return
-
-        if not -12 <= offset <= 14:
-            sign_emoji = "🌍" if offset > 0 else "🌎"
-            await message.answer(
-                f"{sign_emoji} <b>Неверное значение</b>\n\n"
-                f"Часовой пояс <code>{offset}</code> вне допустимого диапазона.\n"
-                f"Допустимо: от <code>-12</code> (Ньюфаундленд) до <code>+14</code> (Киритимати)\n\n"
-                f"✅ Попробуйте: <code>+3</code>, <code>-5</code>, <code>0</code>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text="🕗 +3 (Москва, Минск)")],
-                        [KeyboardButton(text="🕗 +2 (Киев, Варшава)")],
-                        [KeyboardButton(text="🕗 0 (Лондон)")],
-                        [KeyboardButton(text="🕗 -5 (Нью-Йорк)")],
-                        [KeyboardButton(text="❌ Отмена")],
-                    ],
-                    resize_keyboard=True
-                )
-            )
-            return
-
-        # ✅ Сохранение настроек
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].setdefault(uid, {
-            "families": [],
-            "current_family": "",
-            "settings": {"timezone_offset": 0}
-        })
-        old_offset = user["settings"].get("timezone_offset", 0)
-        user["settings"]["timezone_offset"] = offset
-        atomic_save_db(db)
-
-        # 🌐 Расчёт времён
-        server_time_utc = datetime.now(timezone.utc)
-        server_time_msk = server_time_utc + timedelta(hours=3)
-        user_time = server_time_utc + timedelta(hours=offset)
-
-        sign = "+" if offset >= 0 else ""
-        old_sign = "+" if old_offset >= 0 else ""
-
-        # 🎉 Успешное сообщение
-        if old_offset == offset:
-            confetti = "✨"
-            msg = "Ваш часовой пояс уже был установлен на это значение!"
-        else:
-            confetti = "🎉"
-            msg = f"Был: UTC{old_sign}{old_offset} → Стал: UTC{sign}{offset}"
-
+    if not -12 <= offset <= 14:
+        sign_emoji = "🌍" if offset > 0 else "🌎"
         await message.answer(
-            f"{confetti} <b>Часовой пояс обновлён!</b>\n\n"
-            f"🌍 Сервер (МСК): <b>{server_time_msk.strftime('%H:%M')}</b> (UTC+3)\n"
-            f"📱 Ваш пояс: <b>UTC{sign}{offset}</b>\n"
-            f"⏰ Ваше время: <b>{user_time.strftime('%H:%M')}</b>\n\n"
-            f"ℹ️ {msg}\n"
-            f"Теперь все дедлайны и напоминания будут в вашем времени!",
+            f"{sign_emoji} <b>Неверное значение</b>\n\n"
+            f"Часовой пояс <code>{offset}</code> вне допустимого диапазона.\n"
+            f"Допустимо: от <code>-12</code> (Ньюфаундленд) до <code>+14</code> (Киритимати)\n\n"
+            f"✅ Попробуйте: <code>+3</code>, <code>-5</code>, <code>0</code>",
             parse_mode=ParseMode.HTML,
-            reply_markup=get_main_menu_kb()
-        )
-        await state.clear()
-
-    @dp.message(F.text == "❓ Помощь")
-    async def help_handler(message: Message, state: FSMContext) -> None:
-        text = (
-            "❓ <b>Помощь по FoxFamilyTask</b>\n\n"
-            "🏠 <b>Главное меню</b>\n"
-            "• 📋 Мои семьи — список и переключение\n"
-            "• ➕ Создать — новая семья с ключом приглашения\n"
-            "• 🔑 Присоединиться — по ключу от создателя\n\n"
-            "🏡 <b>Меню семьи</b>\n"
-            "• 📋 Задачи — просмотр и обновление прогресса\n"
-            "• ➕ Новая задача — с дедлайнами и напоминаниями\n"
-            "• 👥 Участники — управление членами семьи\n"
-            "• ⚙️ Настройки — только для создателя\n"
-            "• 🏠 Выйти — возврат в главное меню\n\n"
-            "💡 Совет: Используйте /cancel для отмены любой операции"
-        )
-        await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_main_menu_kb())
-
-    # ─── МЕНЮ СЕМЬИ ────────────────────────────────────────────────────
-    @dp.message(F.text == "🏠 Выйти из семьи")
-    async def leave_family_menu(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].get(uid, {})
-        fam_id = user.get("current_family")
-
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
-            return
-
-        fam = db["families"][fam_id]
-        await message.answer(
-            f"❓ Вы уверены, что хотите выйти из семьи «{fam['name']}»?\n\n"
-            "Ваши задачи и прогресс останутся, но вы перестанете получать уведомления.",
             reply_markup=ReplyKeyboardMarkup(
                 keyboard=[
-                    [KeyboardButton(text="✅ Да, выйти")],
-                    [KeyboardButton(text="❌ Нет, остаться")]
+                    [KeyboardButton(text="🕗 +3 (Москва, Минск)")],
+                    [KeyboardButton(text="🕗 +2 (Киев, Варшава)")],
+                    [KeyboardButton(text="🕗 0 (Лондон)")],
+                    [KeyboardButton(text="🕗 -5 (Нью-Йорк)")],
+                    [KeyboardButton(text="❌ Отмена")],
                 ],
                 resize_keyboard=True
             )
         )
-        await state.set_state(FamilyStates.leave_family_confirm)
-
-    @dp.message(FamilyStates.leave_family_confirm)
-    async def leave_family_confirm(message: Message, state: FSMContext) -> None:
-        if message.text == "✅ Да, выйти":
-            db = load_db()
-            uid = str(message.from_user.id)
-            user = db["users"].get(uid, {})
-            fam_id = user.get("current_family")
-
-            if fam_id and fam_id in db["families"]:
-                fam = db["families"][fam_id]
-                # Удаляем пользователя из семьи
-                fam["members"].pop(uid, None)
-                # Удаляем семью из списка пользователя
-                if fam_id in user["families"]:
-                    user["families"].remove(fam_id)
-                user["current_family"] = ""
-
-                # Если семья осталась без участников — удаляем её
-                if not fam["members"]:
-                    db["families"].pop(fam_id, None)
-                    await notify_creator(
-                        message.bot,
-                        fam_id,
-                        f"⚠️ Семья «{fam['name']}» удалена (последний участник вышел)."
-                    )
-                else:
-                    await notify_family(
-                        message.bot,
-                        fam_id,
-                        f"🚪 Участник {fam['members'].get(uid, {}).get('nick', '???')} покинул семью."
-                    )
-
-                atomic_save_db(db)
-                await message.answer(
-                    "✅ Вы вышли из семьи.\nВозврат в главное меню:",
-                    reply_markup=get_main_menu_kb()
-                )
-            else:
-                await message.answer("❌ Ошибка: семья не найдена.", reply_markup=get_main_menu_kb())
-        else:
-            db = load_db()
-            fam_id = db["users"][str(message.from_user.id)].get("current_family")
-            fam_name = db["families"].get(fam_id, {}).get("name", "Семья")
-            await message.answer("↩️ Вы остались в семье.", reply_markup=get_family_menu_kb(fam_name))
+        return
 
-        await state.clear()
+    # ✅ Сохранение настроек
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].setdefault(uid, {
+        "families": [],
+        "current_family": "",
+        "settings": {"timezone_offset": 0}
+    })
+    old_offset = user["settings"].get("timezone_offset", 0)
+    user["settings"]["timezone_offset"] = offset
+    mark_db_dirty()
+
+    # 🌐 Расчёт времён
+    server_time_utc = datetime.now(timezone.utc)
+    server_time_msk = server_time_utc + timedelta(hours=3)
+    user_time = server_time_utc + timedelta(hours=offset)
+
+    sign = "+" if offset >= 0 else ""
+    old_sign = "+" if old_offset >= 0 else ""
+
+    # 🎉 Успешное сообщение
+    if old_offset == offset:
+        confetti = "✨"
+        msg = "Ваш часовой пояс уже был установлен на это значение!"
+    else:
+        confetti = "🎉"
+        msg = f"Был: UTC{old_sign}{old_offset} → Стал: UTC{sign}{offset}"
+
+    await message.answer(
+        f"{confetti} <b>Часовой пояс обновлён!</b>\n\n"
+        f"🌍 Сервер (МСК): <b>{server_time_msk.strftime('%H:%M')}</b> (UTC+3)\n"
+        f"📱 Ваш пояс: <b>UTC{sign}{offset}</b>\n"
+        f"⏰ Ваше время: <b>{user_time.strftime('%H:%M')}</b>\n\n"
+        f"ℹ️ {msg}\n"
+        f"Теперь все дедлайны и напоминания будут в вашем времени!",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_main_menu_kb()
+    )
+    await state.clear()
+
+
+HELP_TEXT = (
+    "❓ <b>Помощь по FoxFamilyTask</b>\n\n"
+    "🏠 <b>Главное меню</b>\n"
+    "• 📋 Мои семьи — список и переключение\n"
+    "• ➕ Создать — новая семья с ключом приглашения\n"
+    "• 🔑 Присоединиться — по ключу от создателя\n\n"
+    "🏡 <b>Меню семьи</b>\n"
+    "• 📋 Задачи — просмотр и обновление прогресса\n"
+    "• ➕ Новая задача — с дедлайнами и напоминаниями\n"
+    "• 👥 Участники — управление членами семьи\n"
+    "• ⚙️ Настройки — только для создателя\n"
+    "• 🏠 Выйти — возврат в главное меню\n\n"
+    "💡 Совет: Используйте /cancel для отмены любой операции"
+)
 
-    @dp.message(F.text.startswith("🏡 "))
-    async def family_overview(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье! Возврат в главное меню.", reply_markup=get_main_menu_kb())
-            return
+@router.message(F.text == "❓ Помощь")
+async def help_handler(message: Message, state: FSMContext) -> None:
+    await message.answer(HELP_TEXT, parse_mode=ParseMode.HTML, reply_markup=get_main_menu_kb())
 
-        fam = db["families"][fam_id]
-        members_list = "\n".join(
-            f"• {m['nick']} (с {datetime.fromtimestamp(m['joined']).strftime('%d.%m')})"
-            for m in fam["members"].values()
-        )
 
-        await message.answer(
-            f"🏡 <b>{fam['name']}</b>\n\n"
-            f"👥 Участники ({len(fam['members'])}):\n{members_list}\n\n"
-            f"✅ Завершённые задачи: {len(fam.get('completed_tasks', {}))}",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(fam["name"])
+# ─── МЕНЮ СЕМЬИ ────────────────────────────────────────────────────
+@router.message(F.text == "🏠 Выйти из семьи")
+async def leave_family_menu(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].get(uid, {})
+    fam_id = user.get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
+        return
+
+    fam = db["families"][fam_id]
+    await message.answer(
+        f"❓ Вы уверены, что хотите выйти из семьи «{fam['name']}»?\n\n"
+        "Ваши задачи и прогресс останутся, но вы перестанете получать уведомления.",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text="✅ Да, выйти")],
+                [KeyboardButton(text="❌ Нет, остаться")]
+            ],
+            resize_keyboard=True
         )
+    )
+    await state.set_state(FamilyStates.leave_family_confirm)
 
-    @dp.message(F.text == "👥 Участники")
-    async def family_members(message: Message, state: FSMContext) -> None:
+
+@router.message(FamilyStates.leave_family_confirm)
+async def leave_family_confirm(message: Message, state: FSMContext) -> None:
+    if message.text == "✅ Да, выйти":
         db = load_db()
         uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+        user = db["users"].get(uid, {})
+        fam_id = user.get("current_family")
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
-            return
+        if fam_id and fam_id in db["families"]:
+            fam = db["families"][fam_id]
+            # Удаляем пользователя из семьи
+            remove_member(fam, uid)
+            # Удаляем семью из списка пользователя
+            if fam_id in user["families"]:
+                user["families"].remove(fam_id)
+            user["current_family"] = ""
 
-        fam = db["families"][fam_id]
-        creator_id = fam.get("creator_id")
-        is_creator = (uid == creator_id)
-
-        # Формируем список участников
-        members_text = "👥 <b>Участники семьи:</b>\n\n"
-        for member_id, member in fam["members"].items():
-            nick = member["nick"]
-            joined = datetime.fromtimestamp(member["joined"]).strftime("%d.%m.%Y")
-            role = "👑 Создатель" if member_id == creator_id else "👤 Участник"
-            you = " ← вы" if member_id == uid else ""
-            members_text += f"• {nick} ({role}, с {joined}){you}\n"
-
-        if is_creator:
-            active_key = fam.get("active_key")
-            if active_key and time.time() < active_key["expires"]:
-                key_str = active_key["value"]
-                expires_in = int(active_key["expires"] - time.time())
-                members_text += (
-                    f"\n🔐 <b>Ключ приглашения (только для вас):</b>\n"
-                    f"<code>{key_str}</code>\n"
-                    f"⏳ Действует ещё: {expires_in // 60} мин {expires_in % 60} сек"
+            # Если семья осталась без участников — удаляем её
+            if not fam["members"]:
+                await notify_creator(
+                    message.bot,
+                    fam_id,
+                    f"⚠️ Семья «{fam['name']}» удалена (последний участник вышел)."
                 )
+                set_family_key(db, fam_id, None)
+                db["families"].pop(fam_id, None)
+                drop_family_journal(fam_id)
             else:
-                members_text += (
-                    "\n🔐 <b>Ключ приглашения:</b>\n"
-                    "❌ Истёк или не сгенерирован.\n"
-                    "Нажмите «⚙️ Настройки семьи» → «🔑 Новый ключ приглашения»"
+                await notify_family(
+                    message.bot,
+                    fam_id,
+                    f"🚪 Участник {fam['members'].get(uid, {}).get('nick', '???')} покинул семью."
                 )
 
-        await message.answer(
-            members_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(fam["name"])
-        )
-
-    @dp.message(F.text == "⚙️ Настройки семьи")
-    async def family_settings(message: Message, state: FSMContext) -> None:
+            mark_db_dirty()
+            await message.answer(
+                "✅ Вы вышли из семьи.\nВозврат в главное меню:",
+                reply_markup=get_main_menu_kb()
+            )
+        else:
+            await message.answer("❌ Ошибка: семья не найдена.", reply_markup=get_main_menu_kb())
+    else:
         db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+        fam_id = db["users"][str(message.from_user.id)].get("current_family")
+        fam_name = db["families"].get(fam_id, {}).get("name", "Семья")
+        await message.answer("↩️ Вы остались в семье.", reply_markup=get_family_menu_kb(fam_name))
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
-            return
+    await state.clear()
 
-        fam = db["families"][fam_id]
-        if fam.get("creator_id") != uid:
-            await message.answer(
-                "❌ Только создатель семьи может изменять настройки.",
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-            return
 
-        builder = InlineKeyboardBuilder()
-        builder.button(text="✏️ Изменить название", callback_data="fam_settings:name")
-        builder.button(text="🔑 Новый ключ приглашения", callback_data="fam_settings:new_key")
-        builder.button(text="🏆 Подписка", callback_data="fam_settings:subscription")
-        builder.button(text="🗑️ Удалить семью", callback_data="fam_settings:delete")
-        builder.adjust(1)
+@router.message(F.text.startswith("🏡 "))
+async def family_overview(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье! Возврат в главное меню.", reply_markup=get_main_menu_kb())
+        return
+
+    fam = db["families"][fam_id]
+    members = fam["members"]
+    members_list = "\n".join(
+        f"• {m['nick']} (с {get_joined_str(m)})"
+        for m in members.values()
+    )
 
-        await message.answer(
-            f"⚙️ <b>Настройки семьи «{fam['name']}»</b>\n\n"
-            f"Участников: {len(fam['members'])}/{MAX_FREE_MEMBERS} (бесплатно)\n"
-            f"Задач создано: {len(fam.get('tasks', {})) + len(fam.get('completed_tasks', {}))}",
-            reply_markup=builder.as_markup(),
-            parse_mode=ParseMode.HTML
-        )
+    await message.answer(
+        f"🏡 <b>{fam['name']}</b>\n\n"
+        f"👥 Участники ({len(members)}):\n{members_list}\n\n"
+        f"✅ Завершённые задачи: {len(fam.get('completed_tasks', {}))}",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
 
-    @dp.callback_query(F.data == "fam_settings:name")
-    async def change_name_start(cq: CallbackQuery, state: FSMContext) -> None:
-        await state.set_state(FamilyStates.change_name)
-        await cq.message.answer("✏️ Введите новое название семьи (до 50 символов):", reply_markup=get_cancel_kb())
-        await cq.answer()
 
-    @dp.message(FamilyStates.change_name)
-    async def change_name_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
+@router.message(F.text == "👥 Участники")
+async def family_members(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
 
-        new_name = message.text.strip()[:50]
-        if not new_name:
-            await message.answer("❌ Название не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
-            return
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
+        return
 
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    fam = db["families"][fam_id]
+    creator_id = fam.get("creator_id")
+    is_creator = (uid == creator_id)
+
+    # Формируем список участников
+    parts = ["👥 <b>Участники семьи:</b>\n\n"]
+    for member_id, member in fam["members"].items():
+        nick = member["nick"]
+        joined = get_joined_str(member, full=True)
+        role = "👑 Создатель" if member_id == creator_id else "👤 Участник"
+        you = " ← вы" if member_id == uid else ""
+        parts.append(f"• {nick} ({role}, с {joined}){you}\n")
+
+    if is_creator:
+        active_key = fam.get("active_key")
+        if active_key and time.time() < active_key["expires"]:
+            key_str = active_key["value"]
+            expires_in = int(active_key["expires"] - time.time())
+            parts.append(
+                f"\n🔐 <b>Ключ приглашения (только для вас):</b>\n"
+                f"<code>{key_str}</code>\n"
+                f"⏳ Действует ещё: {expires_in // 60} мин {expires_in % 60} сек"
+            )
+        else:
+            parts.append(
+                "\n🔐 <b>Ключ приглашения:</b>\n"
+                "❌ Истёк или не сгенерирован.\n"
+                "Нажмите «⚙️ Настройки семьи» → «🔑 Новый ключ приглашения»"
+            )
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Ошибка: семья не найдена.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
+    await message.answer(
+        "".join(parts),
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
 
-        db["families"][fam_id]["name"] = new_name
-        atomic_save_db(db)
 
-        await notify_family(
-            message.bot,
-            fam_id,
-            f"🏷️ Название семьи изменено на «{new_name}»"
-        )
+@router.message(F.text == "⚙️ Настройки семьи")
+async def family_settings(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
+        return
+
+    fam = db["families"][fam_id]
+    if fam.get("creator_id") != uid:
         await message.answer(
-            f"✅ Название изменено на «{new_name}»",
-            reply_markup=get_family_menu_kb(new_name)
+            "❌ Только создатель семьи может изменять настройки.",
+            reply_markup=get_family_menu_kb(fam["name"])
         )
-        await state.clear()
+        return
+
+    await message.answer(
+        f"⚙️ <b>Настройки семьи «{fam['name']}»</b>\n\n"
+        f"Участников: {len(fam['members'])}/{MAX_FREE_MEMBERS} (бесплатно)\n"
+        f"Задач создано: {len(fam.get('tasks', {})) + len(fam.get('completed_tasks', {}))}",
+        reply_markup=FAM_SETTINGS_KB,
+        parse_mode=ParseMode.HTML
+    )
 
-    @dp.callback_query(F.data == "fam_settings:new_key")
-    async def generate_new_key(cq: CallbackQuery, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
 
-        if not fam_id or fam_id not in db["families"] or db["families"][fam_id].get("creator_id") != uid:
-            await cq.answer("❌ Только создатель может генерировать ключи!", show_alert=True)
-            return
+@router.callback_query(F.data == "fam_settings:name")
+async def change_name_start(cq: CallbackQuery, state: FSMContext) -> None:
+    await state.set_state(FamilyStates.change_name)
+    await cq.message.answer("✏️ Введите новое название семьи (до 50 символов):", reply_markup=get_cancel_kb())
+    await cq.answer()
 
-        # Генерируем новый ключ
-        new_key = generate_family_key()
-        db["families"][fam_id]["active_key"] = new_key
-        atomic_save_db(db)
 
-        await cq.message.edit_text(
-            f"✅ Новый ключ приглашения сгенерирован!\n\n"
-            f"🔑 <code>{new_key['value']}</code>\n"
-            f"Действует 10 минут.",
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад к настройкам", callback_data="fam_settings:back")]
-            ])
-        )
-        await cq.answer("Ключ обновлён!")
-
-    @dp.callback_query(F.data == "fam_settings:subscription")
-    async def subscription_info(cq: CallbackQuery, state: FSMContext) -> None:
-        text = (
-            "🏆 <b>Подписка FoxFamily Pro</b>\n\n"
-            "Расширяет возможности семьи:\n"
-            "• До 50 участников — 100 ⭐/мес\n"
-            "• До 75 участников — 200 ⭐/мес\n"
-            "• До 100 участников — 350 ⭐/мес\n"
-            "• Приоритетная поддержка\n"
-            "• Облачная синхронизация\n\n"
-            "ℹ️ Оплата через Telegram Stars. Для активации обратитесь к @FoxFamilySupport"
-        )
-        await cq.message.edit_text(
-            text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="fam_settings:back")]
-            ])
-        )
-        await cq.answer()
+@router.message(FamilyStates.change_name)
+async def change_name_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-    @dp.callback_query(F.data == "fam_settings:delete")
-    async def delete_family_confirm(cq: CallbackQuery, state: FSMContext) -> None:
-        await cq.message.edit_text(
-            "⚠️ <b>Внимание!</b>\n\n"
-            "Удаление семьи приведёт к:\n"
-            "• Удалению всех задач и прогресса\n"
-            "• Удалению всех участников\n"
-            "• Безвозвратной потере данных\n\n"
-            "Вы уверены?",
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Да, удалить", callback_data="fam_settings:delete_confirm")],
-                [InlineKeyboardButton(text="❌ Нет, отмена", callback_data="fam_settings:back")]
-            ])
-        )
-        await cq.answer()
+    new_name = message.text.strip()[:50]
+    if not new_name:
+        await message.answer("❌ Название не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
+        return
 
-    @dp.callback_query(F.data == "fam_settings:delete_confirm")
-    async def delete_family(cq: CallbackQuery, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
 
-        if not fam_id or fam_id not in db["families"] or db["families"][fam_id].get("creator_id") != uid:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Ошибка: семья не найдена.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
 
-        fam_name = db["families"][fam_id]["name"]
-        # Удаляем семью
-        del db["families"][fam_id]
-        # Удаляем семью из всех пользователей
-        for user in db["users"].values():
-            if fam_id in user.get("families", []):
-                user["families"].remove(fam_id)
-            if user.get("current_family") == fam_id:
-                user["current_family"] = ""
+    db["families"][fam_id]["name"] = new_name
+    mark_db_dirty()
 
-        atomic_save_db(db)
+    await notify_family(
+        message.bot,
+        fam_id,
+        f"🏷️ Название семьи изменено на «{new_name}»"
+    )
+    await message.answer(
+        f"✅ Название изменено на «{new_name}»",
+        reply_markup=get_family_menu_kb(new_name)
+    )
+    await state.clear()
 
-        await cq.message.edit_text(
-            f"✅ Семья «{fam_name}» удалена.\nВозврат в главное меню:",
-            reply_markup=None
-        )
-        await cq.message.answer("🏠 Главное меню:", reply_markup=get_main_menu_kb())
-        await cq.answer("Семья удалена!")
 
-    @dp.callback_query(F.data == "fam_settings:back")
-    async def settings_back(cq: CallbackQuery, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-        fam = db["families"].get(fam_id, {})
+@router.callback_query(F.data == "fam_settings:new_key")
+async def generate_new_key(cq: CallbackQuery, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"] or db["families"][fam_id].get("creator_id") != uid:
+        await cq.answer("❌ Только создатель может генерировать ключи!", show_alert=True)
+        return
+
+    # Генерируем новый ключ
+    new_key = generate_family_key()
+    set_family_key(db, fam_id, new_key)
+    mark_db_dirty()
+
+    await cq.message.edit_text(
+        f"✅ Новый ключ приглашения сгенерирован!\n\n"
+        f"🔑 <code>{new_key['value']}</code>\n"
+        f"Действует 10 минут.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=BACK_TO_SETTINGS_KB
+    )
+    await cq.answer("Ключ обновлён!")
+
+
+@router.callback_query(F.data == "fam_settings:subscription")
+async def subscription_info(cq: CallbackQuery, state: FSMContext) -> None:
+    text = (
+        "🏆 <b>Подписка FoxFamily Pro</b>\n\n"
+        "Расширяет возможности семьи:\n"
+        "• До 50 участников — 100 ⭐/мес\n"
+        "• До 75 участников — 200 ⭐/мес\n"
+        "• До 100 участников — 350 ⭐/мес\n"
+        "• Приоритетная поддержка\n"
+        "• Облачная синхронизация\n\n"
+        "ℹ️ Оплата через Telegram Stars. Для активации обратитесь к @FoxFamilySupport"
+    )
+    await cq.message.edit_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=BACK_TO_SETTINGS_KB
+    )
+    await cq.answer()
+
+
+@router.callback_query(F.data == "fam_settings:delete")
+async def delete_family_confirm(cq: CallbackQuery, state: FSMContext) -> None:
+    await cq.message.edit_text(
+        "⚠️ <b>Внимание!</b>\n\n"
+        "Удаление семьи приведёт к:\n"
+        "• Удалению всех задач и прогресса\n"
+        "• Удалению всех участников\n"
+        "• Безвозвратной потере данных\n\n"
+        "Вы уверены?",
+        parse_mode=ParseMode.HTML,
+        reply_markup=DELETE_FAMILY_CONFIRM_KB
+    )
+    await cq.answer()
 
-        builder = InlineKeyboardBuilder()
-        builder.button(text="✏️ Изменить название", callback_data="fam_settings:name")
-        builder.button(text="🔑 Новый ключ приглашения", callback_data="fam_settings:new_key")
-        builder.button(text="🏆 Подписка", callback_data="fam_settings:subscription")
-        builder.button(text="🗑️ Удалить семью", callback_data="fam_settings:delete")
-        builder.adjust(1)
 
-        await cq.message.edit_text(
-            f"⚙️ <b>Настройки семьи «{fam.get('name', 'Семья')}»</b>",
-            reply_markup=builder.as_markup(),
-            parse_mode=ParseMode.HTML
-        )
-        await cq.answer()
+@router.callback_query(F.data == "fam_settings:delete_confirm")
+async def delete_family(cq: CallbackQuery, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"] or db["families"][fam_id].get("creator_id") != uid:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
+
+    # Удаляем семью
+    set_family_key(db, fam_id, None)
+    fam = db["families"].pop(fam_id)
+    fam_name = fam["name"]
+    drop_family_journal(fam_id)
+    # Удаляем семью у её участников (и создателя) — без обхода всех пользователей
+    for member_id in {*fam["members"], uid}:
+        user = db["users"].get(member_id)
+        if user is None:
+            continue
+        if fam_id in user.get("families", []):
+            user["families"].remove(fam_id)
+        if user.get("current_family") == fam_id:
+            user["current_family"] = ""
+
+    mark_db_dirty()
+
+    await cq.message.edit_text(
+        f"✅ Семья «{fam_name}» удалена.\nВозврат в главное меню:",
+        reply_markup=None
+    )
+    await cq.message.answer("🏠 Главное меню:", reply_markup=get_main_menu_kb())
+    await cq.answer("Семья удалена!")
 
-    # ─── ЗАДАЧИ ────────────────────────────────────────────────────────
-    @dp.message(F.text == "📋 Задачи")
-    async def tasks_list(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
 
-        # Проверка доступа к семье
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer(
-                "❌ <b>Ошибка доступа</b>\n"
-                "Вы не состоите ни в одной семье.\n"
-                "→ Создайте семью или присоединитесь по ключу",
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_main_menu_kb()
-            )
-            return
+@router.callback_query(F.data == "fam_settings:back")
+async def settings_back(cq: CallbackQuery, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+    fam = db["families"].get(fam_id, {})
 
-        fam = db["families"][fam_id]
-        tasks = fam.get("tasks", {})
-        completed = fam.get("completed_tasks", {})
+    await cq.message.edit_text(
+        f"⚙️ <b>Настройки семьи «{fam.get('name', 'Семья')}»</b>",
+        reply_markup=FAM_SETTINGS_KB,
+        parse_mode=ParseMode.HTML
+    )
+    await cq.answer()
 
-        # Пустой список задач — дружелюбное сообщение с эмодзи
-        if not tasks and not completed:
-            await message.answer(
-                "📭 <b>Список задач пуст</b>\n\n"
-                "✨ Начните с создания первой задачи!\n"
-                "→ Нажмите «➕ Новая задача» в меню семьи\n\n"
-                "💡 Совет: Добавьте дедлайн и напоминание — "
-                "бот автоматически уведомит всех участников!",
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-            return
 
-        # Только завершённые задачи
-        if not tasks and completed:
-            await message.answer(
-                "✅ <b>Все задачи завершены!</b>\n\n"
-                f"🎉 Отличная работа, семья «{fam['name']}»!\n"
-                "Нет активных задач на данный момент.\n\n"
-                "→ Создайте новую задачу, чтобы продолжить планировать!",
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-            return
+# ─── ЗАДАЧИ ────────────────────────────────────────────────────────
+@router.message(F.text == "📋 Задачи")
+async def tasks_list(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
 
-        # Сортируем задачи по приближению дедлайна
-        sorted_tasks = sorted(
-            tasks.items(),
-            key=lambda x: datetime.strptime(x[1]["deadline"], "%d.%m.%Y %H:%M").timestamp()
-            if x[1].get("deadline") else float('inf')
+    # Проверка доступа к семье
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer(
+            "❌ <b>Ошибка доступа</b>\n"
+            "Вы не состоите ни в одной семье.\n"
+            "→ Создайте семью или присоединитесь по ключу",
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_main_menu_kb()
         )
+        return
 
-        text = "📋 <b>Активные задачи семьи</b>\n\n"
-        builder = InlineKeyboardBuilder()
-
-        for idx, (task_id, task) in enumerate(sorted_tasks, 1):
-            deadline_str = format_deadline(task["deadline"]) if task.get("deadline") else "⏱️ Без дедлайна"
-            bar = progress_bar(task.get("progress", 0))
-            assignees = ", ".join(task.get("assignees", [])) or "не назначена"
-            task_type_emoji = {
-                "shopping": "🛒", "trip": "🚗", "cleaning": "🧹",
-                "event": "🎂", "regular": "📝"
-            }.get(task["type"], "📝")
-
-            text += (
-                f"{task_type_emoji} <b>{idx}. {task['desc']}</b>\n"
-                f"   {bar} | {deadline_str}\n"
-                f"   👥 Исполнители: {assignees}\n\n"
-            )
-            builder.button(text=f"{idx}. {task['desc'][:25]}...", callback_data=f"task:edit:{task_id}")
-
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
-        builder.row(InlineKeyboardButton(text="➕ Создать задачу", callback_data="tasks:new"))
+    fam = db["families"][fam_id]
+    tasks = fam.get("tasks", {})
+    completed = fam.get("completed_tasks", {})
 
+    # Пустой список задач — дружелюбное сообщение с эмодзи
+    if not tasks and not completed:
         await message.answer(
-            text,
+            "📭 <b>Список задач пуст</b>\n\n"
+            "✨ Начните с создания первой задачи!\n"
+            "→ Нажмите «➕ Новая задача» в меню семьи\n\n"
+            "💡 Совет: Добавьте дедлайн и напоминание — "
+            "бот автоматически уведомит всех участников!",
             parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
+            reply_markup=get_family_menu_kb(fam["name"])
         )
+        return
 
-        # Сортируем задачи по приближению дедлайна
-        sorted_tasks = sorted(
-            tasks.items(),
-            key=lambda x: datetime.strptime(x[1]["deadline"], "%d.%m.%Y %H:%M").timestamp()
-            if "deadline" in x[1] else float('inf')
+    # Только завершённые задачи
+    if not tasks and completed:
+        await message.answer(
+            "✅ <b>Все задачи завершены!</b>\n\n"
+            f"🎉 Отличная работа, семья «{fam['name']}»!\n"
+            "Нет активных задач на данный момент.\n\n"
+            "→ Создайте новую задачу, чтобы продолжить планировать!",
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_family_menu_kb(fam["name"])
         )
+        return
 
-        text = "📋 <b>Активные задачи:</b>\n\n"
-        builder = InlineKeyboardBuilder()
+    # Сортируем задачи по приближению дедлайна
+    sorted_tasks = sort_tasks_by_deadline(tasks)
 
-        for idx, (task_id, task) in enumerate(sorted_tasks, 1):
-            deadline_str = format_deadline(task["deadline"]) if "deadline" in task else "⏱️ Без дедлайна"
-            bar = progress_bar(task.get("progress", 0))
-            assignees = ", ".join(task.get("assignees", [])) or "не назначена"
+    parts = ["📋 <b>Активные задачи семьи</b>\n\n"]
+    builder = InlineKeyboardBuilder()
 
-            text += (
-                f"{idx}. {task['desc']}\n"
-                f"   {bar} | {deadline_str}\n"
-                f"   Исполнители: {assignees}\n\n"
-            )
-            builder.button(text=f"✏️ {idx}. {task['desc'][:20]}...", callback_data=f"task:edit:{task_id}")
+    for idx, (task_id, task) in enumerate(sorted_tasks, 1):
+        deadline_str = format_deadline(task["deadline"], get_deadline_ts(task)) if task.get("deadline") else "⏱️ Без дедлайна"
+        parts.append(render_task_row(task) % (idx, deadline_str))
+        parts.append("\n")
+        short = task.get("desc_short") or f"{task['desc'][:25]}..."
+        builder.button(text=f"{idx}. {short}", callback_data=f"task:edit:{task_id}")
 
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
-        builder.row(InlineKeyboardButton(text="➕ Новая задача", callback_data="tasks:new"))
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
+    builder.row(InlineKeyboardButton(text="➕ Создать задачу", callback_data="tasks:new"))
 
-        await message.answer(
-            text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
+    await message.answer(
+        "".join(parts),
+        parse_mode=ParseMode.HTML,
+        reply_markup=builder.as_markup()
+    )
 
-    @dp.callback_query(F.data == "tasks:new")
-    async def new_task_start(cq: CallbackQuery, state: FSMContext) -> None:
-        builder = InlineKeyboardBuilder()
-        for display, value in TASK_TYPES.items():
-            builder.button(text=display, callback_data=f"task_type:{value}")
-        builder.adjust(2)
+    # Сортируем задачи по приближению дедлайна
+    sorted_tasks = sort_tasks_by_deadline(tasks)
 
-        await cq.message.answer(  # ← ВАЖНО: используем answer вместо edit_text
-            "📝 <b>Выберите тип задачи:</b>",
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-        await cq.answer()
-        await state.set_state(FamilyStates.create_task_type)
+    parts = ["📋 <b>Активные задачи:</b>\n\n"]
+    builder = InlineKeyboardBuilder()
 
-    @dp.callback_query(F.data.startswith("task_type:"))
-    async def task_type_selected(cq: CallbackQuery, state: FSMContext) -> None:
-        task_type = cq.data.split(":")[1]
+    for idx, (task_id, task) in enumerate(sorted_tasks, 1):
+        deadline_str = format_deadline(task["deadline"], get_deadline_ts(task)) if "deadline" in task else "⏱️ Без дедлайна"
+        bar = progress_bar(task.get("progress", 0))
+        assignees = ", ".join(task.get("assignees", [])) or "не назначена"
 
-        # 🛒 СПЕЦИАЛЬНЫЙ ДИАЛОГ ДЛЯ ПОКУПОК
-        if task_type == "shopping":
-            builder = InlineKeyboardBuilder()
-            categories = [
-                ("🥛 Продукты питания", "food"),
-                ("🔧 Автозапчасти", "auto"),
-                ("🛠️ Хозтовары", "household"),
-                ("💊 Аптека", "pharmacy"),
-                ("👕 Одежда/обувь", "clothing"),
-                ("🎁 Другое", "other")
-            ]
-            for text, value in categories:
-                builder.button(text=text, callback_data=f"shop_cat:{value}")
-            builder.adjust(2)
-
-            await state.update_data(task_type="shopping")
-            await state.set_state(FamilyStates.create_task_shop_category)
-            await cq.message.answer(
-                "🛒 <b>Выберите категорию покупок:</b>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=builder.as_markup()
-            )
-            await cq.answer()
-            return
+        parts.append(
+            f"{idx}. {task['desc']}\n"
+            f"   {bar} | {deadline_str}\n"
+            f"   Исполнители: {assignees}\n\n"
+        )
+        builder.button(text=f"✏️ {idx}. {task['desc'][:20]}...", callback_data=f"task:edit:{task_id}")
 
-        # 📝 ОБЫЧНЫЕ ЗАДАЧИ
-        display_type = next((k for k, v in TASK_TYPES.items() if v == task_type), "Обычная")
-        await state.update_data(task_type=task_type, display_type=display_type)
-        await state.set_state(FamilyStates.create_task_desc)
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
+    builder.row(InlineKeyboardButton(text="➕ Новая задача", callback_data="tasks:new"))
 
-        examples = {
-            "regular": "Вынести мусор до 19:00",
-            "trip": "Съездить на дачу в субботу",
-            "cleaning": "Помыть окна в гостиной",
-            "event": "Подготовить торт ко дню рождения"
-        }
-        example = examples.get(task_type, "Опишите задачу кратко")
+    await message.answer(
+        "".join(parts),
+        parse_mode=ParseMode.HTML,
+        reply_markup=builder.as_markup()
+    )
 
-        await cq.message.answer(
-            f"✏️ <b>{display_type}</b>\nПример: <i>{example}</i>",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_cancel_kb()
-        )
-        await cq.answer()
 
-    @dp.callback_query(F.data.startswith("shop_cat:"))
-    async def shop_category_selected(cq: CallbackQuery, state: FSMContext) -> None:
-        """Выбор категории покупок → переход к вводу списка"""
-        category = cq.data.split(":")[1]
-        category_names = {
-            "food": "Продукты питания",
-            "auto": "Автозапчасти",
-            "household": "Хозтовары",
-            "pharmacy": "Аптека",
-            "clothing": "Одежда/обувь",
-            "other": "Другое"
-        }
+@router.callback_query(F.data == "tasks:new")
+async def new_task_start(cq: CallbackQuery, state: FSMContext) -> None:
+    await cq.message.answer(  # ← ВАЖНО: используем answer вместо edit_text
+        "📝 <b>Выберите тип задачи:</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=TASK_TYPE_KB
+    )
+    await cq.answer()
+    await state.set_state(FamilyStates.create_task_type)
 
-        # Сохраняем категорию
-        await state.update_data(shop_category=category)
-
-        # Формируем подсказку в зависимости от категории
-        hints = {
-            "food": (
-                "🥛 <b>Продукты питания</b>\n"
-                "Введите список через новую строку:\n"
-                "<code>Молоко 2л — 2шт\nХлеб бородинский — 1бух\nЯйца — 10шт</code>"
-            ),
-            "auto": (
-                "🔧 <b>Автозапчасти</b>\n"
-                "Укажите модель авто и детали:\n"
-                "<code>ВАЗ-2114\nМасляный фильтр — 1шт\nСвечи зажигания — 4шт</code>"
-            ),
-            "household": (
-                "🛠️ <b>Хозтовары</b>\n"
-                "Введите список:\n"
-                "<code>Моющее средство — 1шт\nЛампочки LED — 3шт</code>"
-            ),
-            "pharmacy": (
-                "💊 <b>Аптека</b>\n"
-                "Введите лекарства:\n"
-                "<code>Парацетамол — 1уп\nВитамины Д3 — 1шт</code>"
-            ),
-            "clothing": (
-                "👕 <b>Одежда/обувь</b>\n"
-                "Введите позиции:\n"
-                "<code>Джинсы 32 — 1шт\nКроссовки 43 — 1пара</code>"
-            ),
-            "other": (
-                "🎁 <b>Другое</b>\n"
-                "Введите список покупок:\n"
-                "<code>Подарок на день рождения\nУпаковочная бумага</code>"
-            )
-        }
 
-        await state.set_state(FamilyStates.create_task_shop_items)
+@router.callback_query(F.data.startswith(CB_TASK_TYPE))
+async def task_type_selected(cq: CallbackQuery, state: FSMContext) -> None:
+    task_type = cq.data[len(CB_TASK_TYPE):]
+
+    # 🛒 СПЕЦИАЛЬНЫЙ ДИАЛОГ ДЛЯ ПОКУПОК
+    if task_type == "shopping":
+        await state.update_data(task_type="shopping")
+        await state.set_state(FamilyStates.create_task_shop_category)
         await cq.message.answer(
-            hints.get(category, "🛒 Введите список покупок (по одной на строку):"),
+            "🛒 <b>Выберите категорию покупок:</b>",
             parse_mode=ParseMode.HTML,
-            reply_markup=get_cancel_kb()
+            reply_markup=SHOP_CATEGORY_KB
         )
         await cq.answer()
+        return
+
+    # 📝 ОБЫЧНЫЕ ЗАДАЧИ
+    display_type = TASK_TYPES_DISPLAY.get(task_type, "Обычная")
+    await state.update_data(task_type=task_type, display_type=display_type)
+    await state.set_state(FamilyStates.create_task_desc)
+
+    examples = {
+        "regular": "Вынести мусор до 19:00",
+        "trip": "Съездить на дачу в субботу",
+        "cleaning": "Помыть окна в гостиной",
+        "event": "Подготовить торт ко дню рождения"
+    }
+    example = examples.get(task_type, "Опишите задачу кратко")
 
-    @dp.message(FamilyStates.create_task_shop_items)
-    async def shop_items_handler(message: Message, state: FSMContext) -> None:
-        """Парсинг списка покупок с количеством"""
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
-
-        # Парсим строки вида "молоко 2л — 2шт" или просто "молоко"
-        items_raw = message.text.strip().split("\n")
-        items = []
-        quantities = []
-
-        for line in items_raw:
-            line = line.strip()
-            if not line:
-                continue
-
-            # Пытаемся извлечь количество через разделитель
-            if "—" in line or "-" in line or "–" in line:
-                # Разделяем по первому вхождению разделителя
-                parts = re.split(r"[—\-–]", line, maxsplit=1)
-                name = parts[0].strip()
-                qty = parts[1].strip() if len(parts) > 1 else "1шт"
-                items.append(name)
-                quantities.append(qty)
-            else:
-                items.append(line)
-                quantities.append("1шт")
-
-        if not items:
-            await message.answer(
-                "❌ Список не может быть пустым. Введите хотя бы один товар:",
-                reply_markup=get_cancel_kb()
-            )
-            return
+    await cq.message.answer(
+        f"✏️ <b>{display_type}</b>\nПример: <i>{example}</i>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
+    await cq.answer()
+
+
+@router.callback_query(F.data.startswith(CB_SHOP_CAT))
+async def shop_category_selected(cq: CallbackQuery, state: FSMContext) -> None:
+    """Выбор категории покупок → переход к вводу списка"""
+    category = cq.data[len(CB_SHOP_CAT):]
+    category_names = {
+        "food": "Продукты питания",
+        "auto": "Автозапчасти",
+        "household": "Хозтовары",
+        "pharmacy": "Аптека",
+        "clothing": "Одежда/обувь",
+        "other": "Другое"
+    }
 
-        if len(items) > 50:
-            await message.answer(
-                "❌ Слишком много товаров (макс. 50). Сократите список:",
-                reply_markup=get_cancel_kb()
-            )
-            return
+    # Сохраняем категорию
+    await state.update_data(shop_category=category)
+
+    # Формируем подсказку в зависимости от категории
+    hints = {
+        "food": (
+            "🥛 <b>Продукты питания</b>\n"
+            "Введите список через новую строку:\n"
+            "<code>Молоко 2л — 2шт\nХлеб бородинский — 1бух\nЯйца — 10шт</code>"
+        ),
+        "auto": (
+            "🔧 <b>Автозапчасти</b>\n"
+            "Укажите модель авто и детали:\n"
+            "<code>ВАЗ-2114\nМасляный фильтр — 1шт\nСвечи зажигания — 4шт</code>"
+        ),
+        "household": (
+            "🛠️ <b>Хозтовары</b>\n"
+            "Введите список:\n"
+            "<code>Моющее средство — 1шт\nЛампочки LED — 3шт</code>"
+        ),
+        "pharmacy": (
+            "💊 <b>Аптека</b>\n"
+            "Введите лекарства:\n"
+            "<code>Парацетамол — 1уп\nВитамины Д3 — 1шт</code>"
+        ),
+        "clothing": (
+            "👕 <b>Одежда/обувь</b>\n"
+            "Введите позиции:\n"
+            "<code>Джинсы 32 — 1шт\nКроссовки 43 — 1пара</code>"
+        ),
+        "other": (
+            "🎁 <b>Другое</b>\n"
+            "Введите список покупок:\n"
+            "<code>Подарок на день рождения\nУпаковочная бумага</code>"
+        )
+    }
 
-        # Сохраняем данные
-        data = await state.get_data()
-        category = data.get("shop_category", "other")
-        category_names = {
-            "food": "Продукты", "auto": "Автозапчасти", "household": "Хозтовары",
-            "pharmacy": "Аптека", "clothing": "Одежда", "other": "Покупки"
-        }
-        desc = f"{category_names.get(category, 'Покупки')}: {len(items)} товаров"
+    await state.set_state(FamilyStates.create_task_shop_items)
+    await cq.message.answer(
+        hints.get(category, "🛒 Введите список покупок (по одной на строку):"),
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
+    await cq.answer()
+
+
+@router.message(FamilyStates.create_task_shop_items)
+async def shop_items_handler(message: Message, state: FSMContext) -> None:
+    """Парсинг списка покупок с количеством"""
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
+
+    # Парсим строки вида "молоко 2л — 2шт" или просто "молоко"
+    items_raw = message.text.strip().split("\n")
+    items = []
+    quantities = []
+
+    for line in items_raw:
+        line = line.strip()
+        if not line:
+            continue
+
+        # Пытаемся извлечь количество через разделитель
+        if "—" in line or "-" in line or "–" in line:
+            # Разделяем по первому вхождению разделителя
+            parts = re.split(r"[—\-–]", line, maxsplit=1)
+            name = parts[0].strip()
+            qty = parts[1].strip() if len(parts) > 1 else "1шт"
+            items.append(name)
+            quantities.append(qty)
+        else:
+            items.append(line)
+            quantities.append("1шт")
 
-        await state.update_data(
-            desc=desc,
-            items=items,
-            quantities=quantities,
-            shop_category=category
+    if not items:
+        await message.answer(
+            "❌ Список не может быть пустым. Введите хотя бы один товар:",
+            reply_markup=get_cancel_kb()
         )
+        return
 
-        # Переход к дедлайну
-        await state.set_state(FamilyStates.create_task_deadline)
+    if len(items) > 50:
         await message.answer(
-            f"✅ <b>Товаров:</b> {len(items)}\n\n"
-            "⏰ <b>К какому сроку?</b>\n"
-            "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code> или «без срока»",
-            parse_mode=ParseMode.HTML,
+            "❌ Слишком много товаров (макс. 50). Сократите список:",
             reply_markup=get_cancel_kb()
         )
+        return
+
+    # Сохраняем данные
+    data = await state.get_data()
+    category = data.get("shop_category", "other")
+    category_names = {
+        "food": "Продукты", "auto": "Автозапчасти", "household": "Хозтовары",
+        "pharmacy": "Аптека", "clothing": "Одежда", "other": "Покупки"
+    }
+    desc = f"{category_names.get(category, 'Покупки')}: {len(items)} товаров"
 
-    @dp.message(FamilyStates.create_task_desc)
-    async def task_desc_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
+    await state.update_data(
+        desc=desc,
+        items=items,
+        quantities=quantities,
+        shop_category=category
+    )
 
-        desc = message.text.strip()
-        if not desc or len(desc) > 200:
-            await message.answer(
-                "❌ Описание должно быть от 1 до 200 символов. Попробуйте снова:",
-                reply_markup=get_cancel_kb()
-            )
-            return
+    # Переход к дедлайну
+    await state.set_state(FamilyStates.create_task_deadline)
+    await message.answer(
+        f"✅ <b>Товаров:</b> {len(items)}\n\n"
+        "⏰ <b>К какому сроку?</b>\n"
+        "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code> или «без срока»",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
+
+
+@router.message(FamilyStates.create_task_desc)
+async def task_desc_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-        await state.update_data(desc=desc)
-        await state.set_state(FamilyStates.create_task_deadline)
+    desc = message.text.strip()
+    if not desc or len(desc) > 200:
         await message.answer(
-            "⏰ <b>К какому сроку выполнить задачу?</b>\n\n"
-            "<b>Формат:</b> ДД.ММ.ГГГГ ЧЧ:ММ\n"
-            "Пример: <code>05.02.2026 18:30</code>\n\n"
-            "Или напишите «без срока»",
-            parse_mode=ParseMode.HTML,
+            "❌ Описание должно быть от 1 до 200 символов. Попробуйте снова:",
             reply_markup=get_cancel_kb()
         )
+        return
+
+    await state.update_data(desc=desc)
+    await state.set_state(FamilyStates.create_task_deadline)
+    await message.answer(
+        "⏰ <b>К какому сроку выполнить задачу?</b>\n\n"
+        "<b>Формат:</b> ДД.ММ.ГГГГ ЧЧ:ММ\n"
+        "Пример: <code>05.02.2026 18:30</code>\n\n"
+        "Или напишите «без срока»",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
 
-    @dp.message(FamilyStates.create_task_deadline)
-    async def task_deadline_handler(message: Message, state: FSMContext) -> None:
-        """Обработчик дедлайна — с умной логикой напоминаний (без напоминаний при отсутствии дедлайна)"""
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
 
-        deadline_input = message.text.strip().lower()
-        data = await state.get_data()
-        task_type = data["task_type"]
-        has_deadline = True
+@router.message(FamilyStates.create_task_deadline)
+async def task_deadline_handler(message: Message, state: FSMContext) -> None:
+    """Обработчик дедлайна — с умной логикой напоминаний (без напоминаний при отсутствии дедлайна)"""
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-        # Обработка "без срока"
-        if deadline_input in ["без срока", "нет", "без", "без дедлайна", "не нужно", "—", "0"]:
-            await state.update_data(deadline=None)
-            has_deadline = False
-        else:
-            try:
-                # Поддержка форматов: "05.02.2026 18:30" и "05.02 18:30"
-                if len(deadline_input) == 16 and deadline_input[2] == '.' and deadline_input[5] == ' ':
-                    today = datetime.now()
-                    deadline_input = f"{deadline_input[:5]}.{today.year} {deadline_input[6:]}"
-
-                deadline_dt = datetime.strptime(deadline_input, "%d.%m.%Y %H:%M")
-                if deadline_dt < datetime.now() - timedelta(hours=1):
-                    await message.answer(
-                        "❌ Дедлайн не может быть в прошлом. Укажите будущее время:",
-                        reply_markup=get_cancel_kb()
-                    )
-                    return
-                await state.update_data(deadline=deadline_dt.strftime("%d.%m.%Y %H:%M"))
-            except ValueError:
+    deadline_input = message.text.strip().lower()
+    data = await state.get_data()
+    task_type = data["task_type"]
+    has_deadline = True
+
+    # Обработка "без срока"
+    if deadline_input in ["без срока", "нет", "без", "без дедлайна", "не нужно", "—", "0"]:
+        await state.update_data(deadline=None, deadline_ts=None)
+        has_deadline = False
+    else:
+        try:
+            # Поддержка форматов: "05.02.2026 18:30" и "05.02 18:30" (текущий год).
+            # Год вставляем в строку, а не через replace(year=...) — иначе 29.02 не разберётся
+            now = datetime.now()
+            if len(deadline_input) == 11:
+                deadline_input = f"{deadline_input[:5]}.{now.year}{deadline_input[5:]}"
+
+            deadline_dt = datetime.strptime(deadline_input, "%d.%m.%Y %H:%M")
+            if deadline_dt < now - ONE_HOUR:
                 await message.answer(
-                    "❌ Неверный формат даты.\n"
-                    "Примеры:\n"
-                    "• <code>05.02.2026 18:30</code>\n"
-                    "• <code>05.02 18:30</code> (текущий год)\n"
-                    "• <code>без срока</code>",
-                    parse_mode=ParseMode.HTML,
+                    "❌ Дедлайн не может быть в прошлом. Укажите будущее время:",
                     reply_markup=get_cancel_kb()
                 )
                 return
-
-        # 🛒 ПОКУПКИ: пропускаем напоминания ВСЕГДА
-        if task_type == "shopping":
-            await create_task_finish(message, state, message.from_user.id)
-            return
-
-        # 🔔 ОБЫЧНЫЕ ЗАДАЧИ: напоминания ТОЛЬКО если есть дедлайн
-        if has_deadline:
-            builder = InlineKeyboardBuilder()
-            for display, seconds in REMINDER_OPTIONS.items():
-                builder.button(text=display, callback_data=f"reminder:{seconds}")
-            builder.adjust(2)
-
-            await state.set_state(FamilyStates.create_task_reminder)
+            await state.update_data(
+                deadline=deadline_dt.strftime("%d.%m.%Y %H:%M"),
+                deadline_ts=deadline_dt.timestamp()
+            )
+        except ValueError:
             await message.answer(
-                "🔔 <b>Нужно ли напомнить о задаче заранее?</b>\n"
-                "Напоминание придёт всем участникам семьи за указанный период до дедлайна.",
+                "❌ Неверный формат даты.\n"
+                "Примеры:\n"
+                "• <code>05.02.2026 18:30</code>\n"
+                "• <code>05.02 18:30</code> (текущий год)\n"
+                "• <code>без срока</code>",
                 parse_mode=ParseMode.HTML,
-                reply_markup=builder.as_markup()
+                reply_markup=get_cancel_kb()
             )
-        else:
-            # Нет дедлайна → нет напоминаний → сразу завершаем
-            await state.update_data(reminder_sec=0)
-            await create_task_finish(message, state, message.from_user.id)
-
-    @dp.callback_query(F.data.startswith("reminder:"))
-    async def reminder_selected(cq: CallbackQuery, state: FSMContext) -> None:
-        seconds = int(cq.data.split(":")[1])
-        await state.update_data(reminder_sec=seconds)
-
-        # Визуальная обратная связь
-        if seconds == 0:
-            await cq.answer("✅ Напоминания отключены", show_alert=False)
-        else:
-            human_time = next(k for k, v in REMINDER_OPTIONS.items() if v == seconds)
-            await cq.answer(f"✅ {human_time}", show_alert=False)
-
-        await create_task_finish(cq.message, state, cq.from_user.id)
-
-    @dp.message(FamilyStates.create_task_desc)
-    async def task_desc_handler(message: Message, state: FSMContext) -> None:
-        """Умный обработчик описания — для покупок принимает описание + список в одном сообщении"""
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
             return
 
-        text_input = message.text.strip()
-        data = await state.get_data()
-        task_type = data["task_type"]
-
-        # 🛒 РЕЖИМ ПОКУПОК: разделяем описание и список по ДВУМ новым строкам (\n\n)
-        if task_type == "shopping":
-            parts = text_input.split("\n\n", 1)  # ← КЛЮЧЕВОЙ РАЗДЕЛИТЕЛЬ
-
-            if len(parts) == 2:
-                # Есть и описание, и список — обрабатываем сразу
-                desc = parts[0].strip()[:200]
-                items_raw = parts[1].strip().split("\n")
-                items = [i.strip() for i in items_raw if i.strip()]
-
-                # Валидация
-                if not desc:
-                    await message.answer(
-                        "❌ Описание не может быть пустым.\n"
-                        "<b>Формат для покупок:</b>\n"
-                        "<code>Что купить?</code>\n\n"
-                        "<code>Молоко\nХлеб\nЯйца</code>",
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=get_cancel_kb()
-                    )
-                    return
-
-                if not items:
-                    await message.answer(
-                        "❌ Список покупок пуст.\n"
-                        "Пример правильного ввода:\n"
-                        "<code>Продукты на неделю</code>\n\n"
-                        "<code>Молоко\nХлеб\nЯйца</code>",
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=get_cancel_kb()
-                    )
-                    return
-
-                if len(items) > 50:
-                    await message.answer(
-                        "❌ Слишком много элементов (макс. 50).\nСократите список:",
-                        reply_markup=get_cancel_kb()
-                    )
-                    return
-
-                # Сохраняем и переходим к дедлайну
-                await state.update_data(desc=desc, items=items)
-                await state.set_state(FamilyStates.create_task_deadline)
+    # 🛒 ПОКУПКИ: пропускаем напоминания ВСЕГДА
+    if task_type == "shopping":
+        await create_task_finish(message, state, message.from_user.id)
+        return
+
+    # 🔔 ОБЫЧНЫЕ ЗАДАЧИ: напоминания ТОЛЬКО если есть дедлайн
+    if has_deadline:
+        await state.set_state(FamilyStates.create_task_reminder)
+        await message.answer(
+            "🔔 <b>Нужно ли напомнить о задаче заранее?</b>\n"
+            "Напоминание придёт всем участникам семьи за указанный период до дедлайна.",
+            parse_mode=ParseMode.HTML,
+            reply_markup=REMINDER_KB
+        )
+    else:
+        # Нет дедлайна → нет напоминаний → сразу завершаем
+        await state.update_data(reminder_sec=0)
+        await create_task_finish(message, state, message.from_user.id)
+
+
+@router.callback_query(F.data.startswith(CB_REMINDER))
+async def reminder_selected(cq: CallbackQuery, state: FSMContext) -> None:
+    seconds = int(cq.data[len(CB_REMINDER):])
+    await state.update_data(reminder_sec=seconds)
+
+    # Визуальная обратная связь
+    if seconds == 0:
+        await cq.answer("✅ Напоминания отключены", show_alert=False)
+    else:
+        human_time = REMINDER_DISPLAY.get(seconds, "⏰ Напоминание")
+        await cq.answer(f"✅ {human_time}", show_alert=False)
+
+    await create_task_finish(cq.message, state, cq.from_user.id)
+
+
+@router.message(FamilyStates.create_task_desc)
+async def task_desc_handler(message: Message, state: FSMContext) -> None:
+    """Умный обработчик описания — для покупок принимает описание + список в одном сообщении"""
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
+
+    text_input = message.text.strip()
+    data = await state.get_data()
+    task_type = data["task_type"]
+
+    # 🛒 РЕЖИМ ПОКУПОК: разделяем описание и список по ДВУМ новым строкам (\n\n)
+    if task_type == "shopping":
+        parts = text_input.split("\n\n", 1)  # ← КЛЮЧЕВОЙ РАЗДЕЛИТЕЛЬ
+
+        if len(parts) == 2:
+            # Есть и описание, и список — обрабатываем сразу
+            desc = parts[0].strip()[:200]
+            items_raw = parts[1].strip().split("\n")
+            items = [i.strip() for i in items_raw if i.strip()]
+
+            # Валидация
+            if not desc:
                 await message.answer(
-                    f"✅ <b>Описание:</b> {desc}\n"
-                    f"✅ <b>Товаров:</b> {len(items)}\n\n"
-                    "⏰ <b>К какому сроку?</b>\n"
-                    "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code> или «без срока»",
+                    "❌ Описание не может быть пустым.\n"
+                    "<b>Формат для покупок:</b>\n"
+                    "<code>Что купить?</code>\n\n"
+                    "<code>Молоко\nХлеб\nЯйца</code>",
                     parse_mode=ParseMode.HTML,
                     reply_markup=get_cancel_kb()
                 )
                 return
 
-        # 📝 ОБЫЧНЫЕ ЗАДАЧИ или НЕПОЛНЫЙ ВВОД ПОКУПОК
-        desc = text_input[:200]
-        if not desc or len(desc) < 1:
-            await message.answer(
-                "❌ Описание должно быть от 1 до 200 символов.\nПопробуйте снова:",
-                reply_markup=get_cancel_kb()
-            )
-            return
+            if not items:
+                await message.answer(
+                    "❌ Список покупок пуст.\n"
+                    "Пример правильного ввода:\n"
+                    "<code>Продукты на неделю</code>\n\n"
+                    "<code>Молоко\nХлеб\nЯйца</code>",
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=get_cancel_kb()
+                )
+                return
 
-        await state.update_data(desc=desc)
+            if len(items) > 50:
+                await message.answer(
+                    "❌ Слишком много элементов (макс. 50).\nСократите список:",
+                    reply_markup=get_cancel_kb()
+                )
+                return
 
-        # Для покупок без списка — запрашиваем отдельно
-        if task_type == "shopping":
+            # Сохраняем и переходим к дедлайну
+            await state.update_data(desc=desc, items=items)
+            await state.set_state(FamilyStates.create_task_deadline)
             await message.answer(
-                "🛒 <b>Теперь введите список покупок</b> (по одной на строку):\n"
-                "<code>Молоко\nХлеб\nЯйца</code>",
+                f"✅ <b>Описание:</b> {desc}\n"
+                f"✅ <b>Товаров:</b> {len(items)}\n\n"
+                "⏰ <b>К какому сроку?</b>\n"
+                "<code>ДД.ММ.ГГГГ ЧЧ:ММ</code> или «без срока»",
                 parse_mode=ParseMode.HTML,
                 reply_markup=get_cancel_kb()
             )
-            # ← НЕ МЕНЯЕМ СОСТОЯНИЕ! Остаёмся в create_task_desc для повторного ввода
             return
 
-        # Для обычных задач — переходим к дедлайну
-        await state.set_state(FamilyStates.create_task_deadline)
+    # 📝 ОБЫЧНЫЕ ЗАДАЧИ или НЕПОЛНЫЙ ВВОД ПОКУПОК
+    desc = text_input[:200]
+    if not desc or len(desc) < 1:
         await message.answer(
-            "⏰ <b>К какому сроку выполнить задачу?</b>\n"
-            "<b>Формат:</b> <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>\n"
-            "Пример: <code>05.02.2026 18:30</code>\n"
-            "Или напишите «без срока»",
-            parse_mode=ParseMode.HTML,
+            "❌ Описание должно быть от 1 до 200 символов.\nПопробуйте снова:",
             reply_markup=get_cancel_kb()
         )
+        return
 
-    async def create_task_finish(message: Message, state: FSMContext, user_id: int) -> None:
-        """Создание задачи с анимацией сохранения"""
-        data = await state.get_data()
-        db = load_db()
-        uid = str(user_id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Ошибка: не удалось определить семью.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
-
-        fam = db["families"][fam_id]
-        task_id = str(uuid.uuid4())
-        nick = fam["members"].get(uid, {}).get("nick", "Участник")
-
-        # Анимация сохранения
-        await show_loading(message.bot, message.chat.id, "Сохраняю задачу...")
-
-        # Создаём задачу
-        task = {
-            "creator_id": uid,
-            "creator_nick": nick,
-            "desc": data["desc"],
-            "type": data["task_type"],
-            "display_type": data.get("display_type", "Обычная"),
-            "deadline": data.get("deadline"),
-            "reminder_sec": data.get("reminder_sec", 0),
-            "progress": 0,
-            "assignees": [nick],
-            "updates": [],
-            "items": data.get("items", []),
-            "quantities": data.get("quantities", []),
-            "items_checked": [False] * len(data.get("items", [])),
-            "shop_category": data.get("shop_category"),
-            "created_at": time.time(),
-            "reminder_sent": False,
-        }
-
-        fam.setdefault("tasks", {})[task_id] = task
-        atomic_save_db(db)
-
-        # Формируем уведомление
-        deadline_str = format_deadline(task["deadline"]) if task.get("deadline") else "⏱️ Без дедлайна"
-        reminder_str = ""
-        if task["reminder_sec"] > 0 and task.get("deadline"):
-            human_time = next(k for k, v in REMINDER_OPTIONS.items() if v == task["reminder_sec"])
-            reminder_str = f"\n🔔 Напоминание: {human_time}"
-
-        notification = (
-            f"✨ <b>Новая задача</b> в семье «{fam['name']}»\n"
-            f"«{task['desc']}» ({task['display_type']})\n"
-            f"{deadline_str}{reminder_str}\n"
-            f"👤 Исполнитель: {nick}"
-        )
-
-        await notify_family(message.bot, fam_id, notification)
+    await state.update_data(desc=desc)
 
-        # Красивое завершение
+    # Для покупок без списка — запрашиваем отдельно
+    if task_type == "shopping":
         await message.answer(
-            "✅ <b>Задача создана!</b>",
+            "🛒 <b>Теперь введите список покупок</b> (по одной на строку):\n"
+            "<code>Молоко\nХлеб\nЯйца</code>",
             parse_mode=ParseMode.HTML,
-            reply_markup=get_family_menu_kb(fam["name"])
-        )
-        await state.clear()
-
-    @dp.callback_query(F.data.startswith("task:edit:"))
-    async def edit_task(cq: CallbackQuery) -> None:
-        """Улучшенное меню задачи с быстрыми действиями"""
-        task_id = cq.data.split(":")[2]
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
-
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
-
-        if not task:
-            await cq.answer("❌ Задача не найдена!", show_alert=True)
-            return
-
-        # 📊 Формируем красивое отображение
-        deadline_str = format_deadline(task["deadline"]) if task.get("deadline") else "⏱️ Без дедлайна"
-        bar = progress_bar(task["progress"])
-        creator = task.get("creator_nick", "Участник")
-
-        text = (
-            f"📝 <b>{task['desc']}</b>\n"
-            f"<i>({task['display_type']})</i>\n\n"
-            f"{'─' * 30}\n"
-            f"📊 Прогресс: {bar}\n"
-            f"⏰ {deadline_str}\n"
-            f"👤 Создал: {creator}\n"
+            reply_markup=get_cancel_kb()
         )
+        # ← НЕ МЕНЯЕМ СОСТОЯНИЕ! Остаёмся в create_task_desc для повторного ввода
+        return
+
+    # Для обычных задач — переходим к дедлайну
+    await state.set_state(FamilyStates.create_task_deadline)
+    await message.answer(
+        "⏰ <b>К какому сроку выполнить задачу?</b>\n"
+        "<b>Формат:</b> <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>\n"
+        "Пример: <code>05.02.2026 18:30</code>\n"
+        "Или напишите «без срока»",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_cancel_kb()
+    )
 
-        if task.get("assignees"):
-            text += f"👥 Исполнители: {', '.join(task['assignees'])}\n"
-
-        if task.get("updates"):
-            last_update = task["updates"][-1]
-            when = datetime.fromtimestamp(last_update["timestamp"]).strftime("%H:%M")
-            text += f"📝 Последнее обновление: {when}\n"
-
-        text += f"{'─' * 30}\n\n"
-
-        # 🎛️ Умное меню действий
-        builder = InlineKeyboardBuilder()
-
-        # 📈 Быстрые кнопки прогресса (только для не-покупок)
-        if task["type"] != "shopping":
-            if task["progress"] < 100:
-                quick_pct = min(100, task["progress"] + 25)
-                builder.button(
-                    text=f"⏩ +25% ({quick_pct}%)",
-                    callback_data=f"task:quickpct:{task_id}:{quick_pct}"
-                )
-
-        # 🛒 Список покупок
-        if task["type"] == "shopping":
-            builder.button(text="🛒 Показать список", callback_data=f"task:items:{task_id}")
 
-        # 📈 Ручное обновление прогресса
-        builder.button(text="✏️ Изменить прогресс", callback_data=f"task:progress:{task_id}")
+async def create_task_finish(message: Message, state: FSMContext, user_id: int) -> None:
+    """Создание задачи с анимацией сохранения"""
+    data = await state.get_data()
 
-        # ✅ Завершить
-        if task["progress"] < 100:
-            builder.button(text="✅ Завершить задачу", callback_data=f"task:complete:{task_id}")
+    # Анимация сохранения — до чтения БД: между поиском семьи и записью задачи не должно быть await
+    await show_loading(message.bot, message.chat.id, "Сохраняю задачу...")
 
-        # 🔙 Назад
-        builder.button(text="⬅️ К списку задач", callback_data="tasks:list")
+    db = load_db()
+    uid = str(user_id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
 
-        builder.adjust(1)
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Ошибка: не удалось определить семью.", reply_markup=get_main_menu_kb())
+        await state.clear()
+        return
+
+    fam = db["families"][fam_id]
+    task_id = generate_task_id(fam)
+    nick = fam["members"].get(uid, {}).get("nick", "Участник")
+
+    # Создаём задачу
+    task = {
+        "creator_id": uid,
+        "creator_nick": nick,
+        "desc": data["desc"],
+        "desc_short": data["desc"][:25] + ("..." if len(data["desc"]) > 25 else ""),
+        "type": data["task_type"],
+        "display_type": data.get("display_type", "Обычная"),
+        "deadline": data.get("deadline"),
+        "deadline_ts": data.get("deadline_ts"),
+        "reminder_sec": data.get("reminder_sec", 0),
+        "progress": 0,
+        "assignees": [nick],
+        "items": data.get("items", []),
+        "quantities": data.get("quantities", []),
+        "items_checked": [False] * len(data.get("items", [])),
+        "items_unchecked_count": len(data.get("items", [])),
+        "shop_category": data.get("shop_category"),
+        "created_at": time.time(),
+        "reminder_sent": False,
+    }
 
-        await cq.message.edit_text(
-            text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-        await cq.answer()
+    fam.setdefault("tasks", {})[task_id] = task
+    mark_db_dirty()
+    schedule_reminder(fam_id, task_id, task)
+
+    # Формируем уведомление
+    deadline_str = format_deadline(task["deadline"], get_deadline_ts(task)) if task.get("deadline") else "⏱️ Без дедлайна"
+    reminder_str = ""
+    if task["reminder_sec"] > 0 and task.get("deadline"):
+        human_time = REMINDER_DISPLAY.get(task["reminder_sec"], "⏰ Напоминание")
+        reminder_str = f"\n🔔 Напоминание: {human_time}"
+
+    notification = (
+        f"✨ <b>Новая задача</b> в семье «{fam['name']}»\n"
+        f"«{task['desc']}» ({task['display_type']})\n"
+        f"{deadline_str}{reminder_str}\n"
+        f"👤 Исполнитель: {nick}"
+    )
 
-    @dp.callback_query(F.data.startswith("task:quickpct:"))
-    async def quick_progress(cq: CallbackQuery) -> None:
-        """Быстрое обновление прогресса +25%"""
-        _, _, task_id, pct_str = cq.data.split(":")
-        new_pct = int(pct_str)
+    await notify_family(message.bot, fam_id, notification)
 
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    # Красивое завершение
+    await message.answer(
+        "✅ <b>Задача создана!</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
+    await state.clear()
 
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
 
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
-        nick = fam["members"][uid]["nick"]
+@router.callback_query(F.data.startswith(CB_TASK_EDIT))
+async def edit_task(cq: CallbackQuery) -> None:
+    """Улучшенное меню задачи с быстрыми действиями"""
+    task_id = cq.data[len(CB_TASK_EDIT):]
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
+
+    fam = db["families"][fam_id]
+    task = fam.get("tasks", {}).get(task_id)
+
+    if not task:
+        await cq.answer(ERR_TASK_NOT_FOUND, show_alert=True)
+        return
+
+    # 📊 Формируем красивое отображение
+    deadline_str = format_deadline(task["deadline"], get_deadline_ts(task)) if task.get("deadline") else "⏱️ Без дедлайна"
+    bar = progress_bar(task["progress"])
+    creator = task.get("creator_nick", "Участник")
+
+    text = (
+        f"📝 <b>{task['desc']}</b>\n"
+        f"<i>({task['display_type']})</i>\n\n"
+        f"{HR_LINE}\n"
+        f"📊 Прогресс: {bar}\n"
+        f"⏰ {deadline_str}\n"
+        f"👤 Создал: {creator}\n"
+    )
 
-        if not task:
-            await cq.answer("❌ Задача не найдена!", show_alert=True)
-            return
+    if task.get("assignees"):
+        text += f"👥 Исполнители: {', '.join(task['assignees'])}\n"
 
-        old_pct = task.get("progress", 0)
-        task["progress"] = new_pct
-        task["updates"].append({
-            "user": nick,
-            "from": old_pct,
-            "to": new_pct,
-            "timestamp": time.time()
-        })
+    last_update_ts = task.get("last_update_ts")
+    if last_update_ts is None and task.get("updates"):  # Задачи со встроенной историей
+        last_update_ts = task["updates"][-1]["timestamp"]
+    if last_update_ts is not None:
+        when = datetime.fromtimestamp(last_update_ts).strftime("%H:%M")
+        text += f"📝 Последнее обновление: {when}\n"
 
-        # Автозавершение при 100%
-        if new_pct == 100:
-            task["completed_at"] = time.time()
-            task["completed_by"] = nick
-            fam.setdefault("completed_tasks", {})[task_id] = task
-            fam["tasks"].pop(task_id, None)
-            atomic_save_db(db)
+    text += f"{HR_LINE}\n\n"
 
-            await notify_family(
-                cq.message.bot,
-                fam_id,
-                f"✅ Задача «{task['desc']}» завершена участником {nick}!"
-            )
+    # 🎛️ Умное меню действий
+    await cq.message.edit_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=build_task_card_kb(task_id, task["type"] == "shopping", task["progress"])
+    )
+    await cq.answer()
 
-            builder = InlineKeyboardBuilder()
-            builder.button(text="📋 К задачам", callback_data="tasks:list")
 
-            await cq.message.edit_text(
-                f"🎉 <b>Задача завершена!</b>\n"
-                f"«{task['desc']}»\n\n"
-                f"✅ Прогресс: {progress_bar(100)}",
-                parse_mode=ParseMode.HTML,
-                reply_markup=builder.as_markup()
-            )
-            await cq.answer(f"✅ Задача завершена!", show_alert=True)
-            return
+@router.callback_query(F.data.startswith(CB_TASK_QUICKPCT))
+async def quick_progress(cq: CallbackQuery) -> None:
+    """Быстрое обновление прогресса +25%"""
+    task_id, _, pct_str = cq.data[len(CB_TASK_QUICKPCT):].rpartition(":")
+    new_pct = int(pct_str)
 
-        atomic_save_db(db)
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
+
+    fam = db["families"][fam_id]
+    task = fam.get("tasks", {}).get(task_id)
+    nick = fam["members"][uid]["nick"]
+
+    if not task:
+        await cq.answer(ERR_TASK_NOT_FOUND, show_alert=True)
+        return
+
+    old_pct = task.get("progress", 0)
+    task["progress"] = new_pct
+    append_task_update(fam_id, task_id, task, {
+        "user": nick,
+        "from": old_pct,
+        "to": new_pct,
+        "timestamp": time.time()
+    })
+
+    # Автозавершение при 100%
+    if new_pct == 100:
+        task["completed_at"] = time.time()
+        task["completed_by"] = nick
+        fam.setdefault("completed_tasks", {})[task_id] = task
+        fam["tasks"].pop(task_id, None)
+        mark_db_dirty()
 
         await notify_family(
             cq.message.bot,
             fam_id,
-            f"📈 {nick} обновил прогресс: {old_pct}% → {new_pct}%\n"
-            f"«{task['desc']}»"
+            f"✅ Задача «{task['desc']}» завершена участником {nick}!"
         )
 
-        # 🔄 Обновляем меню задачи
-        await edit_task(cq)
-        await cq.answer(f"✅ Прогресс: {new_pct}%", show_alert=False)
+        await cq.message.edit_text(
+            f"🎉 <b>Задача завершена!</b>\n"
+            f"«{task['desc']}»\n\n"
+            f"✅ Прогресс: {progress_bar(100)}",
+            parse_mode=ParseMode.HTML,
+            reply_markup=BACK_TO_TASKS_KB
+        )
+        await cq.answer(f"✅ Задача завершена!", show_alert=True)
+        return
 
-    @dp.callback_query(F.data.startswith("task:progress:"))
-    async def update_progress_start(cq: CallbackQuery, state: FSMContext) -> None:
-        task_id = cq.data.split(":")[2]
-        await state.update_data(task_id=task_id)
-        await state.set_state(FamilyStates.update_task_progress)
+    mark_db_dirty()
 
-        await cq.message.answer(
-            "📈 Введите новый прогресс в процентах (0-100):",
-            reply_markup=get_cancel_kb()
-        )
-        await cq.answer()
+    await notify_family(
+        cq.message.bot,
+        fam_id,
+        f"📈 {nick} обновил прогресс: {old_pct}% → {new_pct}%\n"
+        f"«{task['desc']}»"
+    )
 
-    @dp.message(FamilyStates.update_task_progress)
-    async def update_progress_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
+    # 🔄 Обновляем меню задачи
+    await edit_task(cq)
+    await cq.answer(f"✅ Прогресс: {new_pct}%", show_alert=False)
 
-        try:
-            pct = int(message.text.strip())
-            if not 0 <= pct <= 100:
-                raise ValueError
-        except:
-            await message.answer("❌ Введите число от 0 до 100:", reply_markup=get_cancel_kb())
-            return
 
-        data = await state.get_data()
-        task_id = data["task_id"]
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-        nick = db["families"][fam_id]["members"][uid]["nick"]
+@router.callback_query(F.data.startswith(CB_TASK_PROGRESS))
+async def update_progress_start(cq: CallbackQuery, state: FSMContext) -> None:
+    task_id = cq.data[len(CB_TASK_PROGRESS):]
+    await state.update_data(task_id=task_id)
+    await state.set_state(FamilyStates.update_task_progress)
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Ошибка доступа.", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
+    await cq.message.answer(
+        "📈 Введите новый прогресс в процентах (0-100):",
+        reply_markup=get_cancel_kb()
+    )
+    await cq.answer()
 
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
-        if not task:
-            await message.answer("❌ Задача не найдена.", reply_markup=get_family_menu_kb(fam["name"]))
-            await state.clear()
-            return
 
-        # Сохраняем обновление прогресса
-        old_pct = task.get("progress", 0)
-        task["progress"] = pct
-        task["updates"].append({
-            "user": nick,
-            "from": old_pct,
-            "to": pct,
-            "timestamp": time.time()
-        })
+@router.message(FamilyStates.update_task_progress)
+async def update_progress_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-        # Если задача завершена — перемещаем в завершённые
-        if pct == 100:
-            task["completed_at"] = time.time()
-            fam.setdefault("completed_tasks", {})[task_id] = task
-            fam["tasks"].pop(task_id, None)
-            atomic_save_db(db)
+    # Проверяем без исключений: isdecimal() гарантирует успешный int()
+    pct_text = (message.text or "").strip()
+    if not pct_text.isdecimal() or not 0 <= (pct := int(pct_text)) <= 100:
+        await message.answer("❌ Введите число от 0 до 100:", reply_markup=get_cancel_kb())
+        return
 
-            await notify_family(
-                message.bot,
-                fam_id,
-                f"✅ Задача «{task['desc']}» завершена участником {nick}!"
-            )
-            await message.answer(
-                f"🎉 Задача «{task['desc']}» завершена!",
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-        else:
-            atomic_save_db(db)
-            await notify_family(
-                message.bot,
-                fam_id,
-                f"📈 {nick} обновил прогресс задачи «{task['desc']}»: {old_pct}% → {pct}%"
-            )
-            await message.answer(
-                f"✅ Прогресс обновлён: {progress_bar(pct)}",
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
+    data = await state.get_data()
+    task_id = data["task_id"]
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
 
+    if fam is None or uid not in fam["members"]:
+        await message.answer("❌ Ошибка доступа.", reply_markup=get_main_menu_kb())
         await state.clear()
+        return
 
-    @dp.callback_query(F.data.startswith("task:items:"))
-    async def show_shopping_list(cq: CallbackQuery) -> None:
-        """Улучшенный список покупок с количеством и красивым оформлением"""
-        task_id = cq.data.split(":")[2]
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
+    tasks = fam.get("tasks", {})
+    task = tasks.get(task_id)
+    if not task:
+        await message.answer("❌ Задача не найдена.", reply_markup=get_family_menu_kb(fam["name"]))
+        await state.clear()
+        return
+
+    nick = fam["members"][uid]["nick"]
+    now = time.time()
+
+    # Сохраняем обновление прогресса
+    old_pct = task.get("progress", 0)
+    task["progress"] = pct
+    append_task_update(fam_id, task_id, task, {
+        "user": nick,
+        "from": old_pct,
+        "to": pct,
+        "timestamp": now
+    })
+
+    # Если задача завершена — перемещаем в завершённые; изменения сохраняются одной записью
+    if pct == 100:
+        task["completed_at"] = now
+        task["completed_by"] = nick
+        fam.setdefault("completed_tasks", {})[task_id] = task
+        tasks.pop(task_id, None)
+        notice = f"✅ Задача «{task['desc']}» завершена участником {nick}!"
+        reply = f"🎉 Задача «{task['desc']}» завершена!"
+    else:
+        notice = f"📈 {nick} обновил прогресс задачи «{task['desc']}»: {old_pct}% → {pct}%"
+        reply = f"✅ Прогресс обновлён: {progress_bar(pct)}"
+    mark_db_dirty()
+
+    await notify_family(message.bot, fam_id, notice)
+    await message.answer(reply, reply_markup=get_family_menu_kb(fam["name"]))
+    await state.clear()
+
+
+@router.callback_query(F.data.startswith(CB_TASK_ITEMS))
+async def show_shopping_list(cq: CallbackQuery) -> None:
+    """Улучшенный список покупок с количеством и красивым оформлением"""
+    task_id = cq.data[len(CB_TASK_ITEMS):]
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
 
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
-        if not task or task["type"] != "shopping":
-            await cq.answer("❌ Неверная задача!", show_alert=True)
-            return
+    if fam is None:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
 
-        # Формируем красивый список с количеством
-        items_text = f"🛒 <b>{task['desc']}</b>\n"
-        items_text += f"{'─' * 30}\n"
+    task = fam.get("tasks", {}).get(task_id)
+    if not task or task["type"] != "shopping":
+        await cq.answer("❌ Неверная задача!", show_alert=True)
+        return
 
-        builder = InlineKeyboardBuilder()
-        quantities = task.get("quantities", ["1шт"] * len(task["items"]))
+    await cq.answer()  # Быстрый ACK до построения списка
 
-        for idx, (item, checked, qty) in enumerate(zip(task["items"], task["items_checked"], quantities)):
-            mark = "✅" if checked else "🔲"
-            qty_display = f" <code>{qty}</code>" if qty != "1шт" else ""
-            items_text += f"{mark} {item}{qty_display}\n"
+    await edit_if_changed(
+        cq.message,
+        render_shopping_text(task),
+        build_shopping_markup(task_id, tuple(task["items"]), tuple(task["items_checked"]))
+    )
 
-            if not checked:
-                builder.button(
-                    text=f"✓ {item[:20]}",
-                    callback_data=f"item:check:{task_id}:{idx}"
-                )
 
-        items_text += f"{'─' * 30}\n"
-        items_text += f"📦 Осталось купить: {sum(not c for c in task['items_checked'])} из {len(task['items'])}"
+@router.callback_query(F.data.startswith(CB_ITEM_CHECK))
+async def check_item(cq: CallbackQuery) -> None:
+    """Отметить товар как купленный — с сохранением контекста"""
+    task_id, _, idx_str = cq.data[len(CB_ITEM_CHECK):].rpartition(":")
+    item_idx = int(idx_str)
 
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="⬅️ Назад к задаче", callback_data=f"task:edit:{task_id}"))
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
 
-        await cq.message.edit_text(
-            items_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-        await cq.answer()
+    if fam is None or uid not in fam["members"]:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
 
-    @dp.callback_query(F.data.startswith("item:check:"))
-    async def check_item(cq: CallbackQuery) -> None:
-        """Отметить товар как купленный — с сохранением контекста"""
-        parts = cq.data.split(":")
-        task_id, item_idx = parts[2], int(parts[3])
+    tasks = fam.get("tasks", {})
+    task = tasks.get(task_id)
 
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    if not task or task["type"] != "shopping":
+        await cq.answer("❌ Ошибка задачи!", show_alert=True)
+        return
 
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
+    items_checked = task["items_checked"]
 
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
+    # Отмечаем элемент
+    if not items_checked[item_idx]:
         nick = fam["members"][uid]["nick"]
+        now = time.time()
+        item_name = task["items"][item_idx]
+        unchecked = get_unchecked_count(task) - 1
+        task["items_unchecked_count"] = unchecked
+        items_checked[item_idx] = True
+        append_task_update(fam_id, task_id, task, {
+            "user": nick,
+            "action": "checked",
+            "item": item_name,
+            "timestamp": now
+        })
 
-        if not task or task["type"] != "shopping":
-            await cq.answer("❌ Ошибка задачи!", show_alert=True)
-            return
-
-        # Отмечаем элемент
-        if not task["items_checked"][item_idx]:
-            item_name = task["items"][item_idx]
-            task["items_checked"][item_idx] = True
-            task["updates"].append({
-                "user": nick,
-                "action": "checked",
-                "item": item_name,
-                "timestamp": time.time()
-            })
-
-            # Проверяем завершённость
-            if all(task["items_checked"]):
-                task["progress"] = 100
-                task["completed_at"] = time.time()
-                task["completed_by"] = nick
-                fam.setdefault("completed_tasks", {})[task_id] = task
-                fam["tasks"].pop(task_id, None)
-                atomic_save_db(db)
-
-                await notify_family(
-                    cq.message.bot,
-                    fam_id,
-                    f"✅ Список покупок «{task['desc']}» полностью выполнен {nick}!"
-                )
-
-                builder = InlineKeyboardBuilder()
-                builder.button(text="📋 К списку задач", callback_data="tasks:list")
-                builder.button(text="🏡 В меню семьи", callback_data=f"enter_family:{fam_id}")
-
-                await cq.message.edit_text(
-                    f"🎉 <b>Список покупок завершён!</b>\n"
-                    f"«{task['desc']}»\n\n"
-                    f"✅ Куплено: {len(task['items'])} товаров",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=builder.as_markup()
-                )
-                await cq.answer(f"✅ {item_name} — куплено!", show_alert=True)
-                return
+        # Проверяем завершённость
+        if unchecked == 0:
+            task["progress"] = 100
+            task["completed_at"] = now
+            task["completed_by"] = nick
+            fam.setdefault("completed_tasks", {})[task_id] = task
+            tasks.pop(task_id, None)
+            mark_db_dirty()
 
-            atomic_save_db(db)
+            await notify_family(
+                cq.message.bot,
+                fam_id,
+                f"✅ Список покупок «{task['desc']}» полностью выполнен {nick}!"
+            )
 
-            # 🔄 Обновляем только клавиатуру (сохраняем контекст!)
-            items_text = "🛒 <b>Список покупок:</b>\n"
             builder = InlineKeyboardBuilder()
-
-            for idx, (item, checked) in enumerate(zip(task["items"], task["items_checked"])):
-                mark = "✅" if checked else "🔲"
-                items_text += f"{mark} {item}\n"
-                if not checked:
-                    builder.button(text=f"✓ {item}", callback_data=f"item:check:{task_id}:{idx}")
-
-            builder.adjust(1)
-            builder.row(InlineKeyboardButton(text="⬅️ Назад к задаче", callback_data=f"task:edit:{task_id}"))
+            builder.button(text="📋 К списку задач", callback_data="tasks:list")
+            builder.button(text="🏡 В меню семьи", callback_data=f"enter_family:{fam_id}")
 
             await cq.message.edit_text(
-                items_text,
+                f"🎉 <b>Список покупок завершён!</b>\n"
+                f"«{task['desc']}»\n\n"
+                f"✅ Куплено: {len(task['items'])} товаров",
                 parse_mode=ParseMode.HTML,
                 reply_markup=builder.as_markup()
             )
-            await cq.answer(f"✅ {item_name} — куплено!", show_alert=False)
-        else:
-            await cq.answer("ℹ️ Уже куплено!", show_alert=False)
-
-    @dp.callback_query(F.data.startswith("task:complete:"))
-    async def complete_task(cq: CallbackQuery) -> None:
-        task_id = cq.data.split(":")[2]
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
-        nick = db["families"][fam_id]["members"][uid]["nick"]
-
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
+            await cq.answer(f"✅ {item_name} — куплено!", show_alert=True)
             return
 
-        fam = db["families"][fam_id]
-        task = fam.get("tasks", {}).get(task_id)
-        if not task:
-            await cq.answer("❌ Задача не найдена!", show_alert=True)
-            return
+        mark_db_dirty()
+        await cq.answer(f"✅ {item_name} — куплено!", show_alert=False)
+    else:
+        await cq.answer("ℹ️ Уже куплено!", show_alert=False)
 
-        # Перемещаем задачу в завершённые
-        task["progress"] = 100
-        task["completed_at"] = time.time()
-        task["completed_by"] = nick
-        fam.setdefault("completed_tasks", {})[task_id] = task
-        fam["tasks"].pop(task_id, None)
-        atomic_save_db(db)
+    # 🔄 Список и клавиатура — из живого состояния задачи, а не из снимка сообщения:
+    # отметки других участников и быстрые повторные нажатия тоже попадут в сообщение
+    await edit_if_changed(
+        cq.message,
+        render_shopping_text(task),
+        build_shopping_markup(task_id, tuple(task["items"]), tuple(items_checked))
+    )
 
-        await notify_family(
-            cq.message.bot,
-            fam_id,
-            f"✅ Задача «{task['desc']}» завершена участником {nick}!"
-        )
-        await cq.message.edit_text(
-            f"✅ Задача «{task['desc']}» завершена!",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ К задачам", callback_data="tasks:list")]
-            ])
-        )
-        await cq.answer()
 
-    @dp.callback_query(F.data == "tasks:completed")
-    async def show_completed_tasks(cq: CallbackQuery) -> None:
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+@router.callback_query(F.data.startswith(CB_TASK_COMPLETE))
+async def complete_task(cq: CallbackQuery) -> None:
+    task_id = cq.data[len(CB_TASK_COMPLETE):]
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
+
+    if fam is None or uid not in fam["members"]:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
+
+    tasks = fam.get("tasks", {})
+    task = tasks.get(task_id)
+    if not task:
+        await cq.answer(ERR_TASK_NOT_FOUND, show_alert=True)
+        return
+
+    await cq.answer()
+    nick = fam["members"][uid]["nick"]
+
+    # Перемещаем задачу в завершённые
+    task["progress"] = 100
+    task["completed_at"] = time.time()
+    task["completed_by"] = nick
+    fam.setdefault("completed_tasks", {})[task_id] = task
+    tasks.pop(task_id, None)
+    mark_db_dirty()
+
+    await notify_family(
+        cq.message.bot,
+        fam_id,
+        f"✅ Задача «{task['desc']}» завершена участником {nick}!"
+    )
+    await cq.message.edit_text(
+        f"✅ Задача «{task['desc']}» завершена!",
+        reply_markup=BACK_TO_TASKS_KB
+    )
 
-        if not fam_id or fam_id not in db["families"]:
-            await cq.answer("❌ Ошибка доступа!", show_alert=True)
-            return
 
-        fam = db["families"][fam_id]
-        completed = fam.get("completed_tasks", {})
+@router.callback_query(F.data == "tasks:completed")
+async def show_completed_tasks(cq: CallbackQuery) -> None:
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
+
+    if fam is None:
+        await cq.answer(ERR_ACCESS, show_alert=True)
+        return
+
+    completed = fam.get("completed_tasks", {})
+
+    if not completed:
+        await cq.answer("📭 Нет завершённых задач", show_alert=True)
+        return
+
+    # Новые задачи дописываются в конец при завершении, так что порядок словаря — хронологический.
+    # Старые данные могли сохраниться в другом порядке — упорядочиваем их один раз
+    if not fam.get("_completed_sorted"):
+        completed = dict(sorted(completed.items(), key=lambda kv: kv[1].get("completed_at", 0)))
+        fam["completed_tasks"] = completed
+        fam["_completed_sorted"] = True
+        mark_db_dirty()
+
+    parts = ["✅ <b>Завершённые задачи:</b>\n\n"]
+    for task_id, task in islice(reversed(completed.items()), 10):  # Последние 10
+        completed_at = get_completed_at_str(task)
+        by = task.get("completed_by", task.get("creator_nick", "???"))
+        parts.append(f"• {task['desc']} ({task['display_type']})\n  Завершена {completed_at} участником {by}\n\n")
+
+    total = len(completed)
+    if total > 10:
+        parts.append(f"\n... и ещё {total - 10} задач")
+
+    await cq.message.answer(
+        "".join(parts),
+        parse_mode=ParseMode.HTML,
+        reply_markup=BACK_TO_TASKS_KB
+    )
+    await cq.answer()
 
-        if not completed:
-            await cq.answer("📭 Нет завершённых задач", show_alert=True)
-            return
 
-        text = "✅ <b>Завершённые задачи:</b>\n\n"
-        for task_id, task in list(completed.items())[:10]:  # Последние 10
-            created = datetime.fromtimestamp(task["created_at"]).strftime("%d.%m")
-            completed_at = datetime.fromtimestamp(task.get("completed_at", task["created_at"])).strftime("%d.%m %H:%M")
-            by = task.get("completed_by", task.get("creator_nick", "???"))
-            text += f"• {task['desc']} ({task['display_type']})\n  Завершена {completed_at} участником {by}\n\n"
+@router.callback_query(F.data == "tasks:list")
+async def back_to_tasks(cq: CallbackQuery) -> None:
+    """Возврат к списку задач БЕЗ зависимости от состояния"""
+    await cq.answer()  # Алертов здесь нет — подтверждаем нажатие сразу
+    db = load_db()
+    uid = str(cq.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
 
-        if len(completed) > 10:
-            text += f"\n... и ещё {len(completed) - 10} задач"
+    if fam is None:
+        await cq.message.edit_text(
+            "❌ <b>Ошибка доступа</b>\n"
+            "Вы не состоите ни в одной семье.\n"
+            "→ Создайте семью или присоединитесь по ключу",
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_main_menu_kb()
+        )
+        return
 
-        await cq.message.answer(
-            text,
+    # Ручной вызов списка задач (без FSM)
+    tasks = fam.get("tasks", {})
+    completed = fam.get("completed_tasks", {})
+
+    if not tasks and not completed:
+        await cq.message.edit_text(
+            "📭 <b>Список задач пуст</b>\n"
+            "✨ Начните с создания первой задачи!\n"
+            "→ Нажмите «➕ Новая задача» в меню семьи",
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад к задачам", callback_data="tasks:list")]
-            ])
+            reply_markup=get_family_menu_kb(fam["name"])
         )
-        await cq.answer()
+        return
 
-    @dp.callback_query(F.data == "tasks:list")
-    async def back_to_tasks(cq: CallbackQuery) -> None:
-        """Возврат к списку задач БЕЗ зависимости от состояния"""
-        db = load_db()
-        uid = str(cq.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    # Сортировка по дедлайну
+    sorted_tasks = sort_tasks_by_deadline(tasks)
 
-        if not fam_id or fam_id not in db["families"]:
-            await cq.message.edit_text(
-                "❌ <b>Ошибка доступа</b>\n"
-                "Вы не состоите ни в одной семье.\n"
-                "→ Создайте семью или присоединитесь по ключу",
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_main_menu_kb()
-            )
-            await cq.answer()
-            return
+    parts = ["📋 <b>Активные задачи семьи</b>\n"]
+    builder = InlineKeyboardBuilder()
 
-        fam = db["families"][fam_id]
+    for idx, (task_id, task) in enumerate(sorted_tasks, 1):
+        deadline_str = format_deadline(task["deadline"], get_deadline_ts(task)) if task.get("deadline") else "⏱️ Без дедлайна"
+        parts.append(render_task_row(task) % (idx, deadline_str))
+        short = task.get("desc_short") or f"{task['desc'][:25]}..."
+        builder.button(text=f"{idx}. {short}", callback_data=f"task:edit:{task_id}")
 
-        # Ручной вызов списка задач (без FSM)
-        tasks = fam.get("tasks", {})
-        completed = fam.get("completed_tasks", {})
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
+    builder.row(InlineKeyboardButton(text="➕ Создать задачу", callback_data="tasks:new"))
 
-        if not tasks and not completed:
-            await cq.message.edit_text(
-                "📭 <b>Список задач пуст</b>\n"
-                "✨ Начните с создания первой задачи!\n"
-                "→ Нажмите «➕ Новая задача» в меню семьи",
-                parse_mode=ParseMode.HTML,
-                reply_markup=get_family_menu_kb(fam["name"])
-            )
-            await cq.answer()
-            return
+    await edit_if_changed(cq.message, "".join(parts), builder.as_markup())
 
-        # Сортировка по дедлайну
-        sorted_tasks = sorted(
-            tasks.items(),
-            key=lambda x: datetime.strptime(x[1]["deadline"], "%d.%m.%Y %H:%M").timestamp()
-            if x[1].get("deadline") else float('inf')
-        )
 
-        text = "📋 <b>Активные задачи семьи</b>\n"
-        builder = InlineKeyboardBuilder()
+@router.message(F.text == "🏠 Вернуться в главное меню")
+async def return_to_main_menu(message: Message, state: FSMContext) -> None:
+    await state.clear()
+    db = load_db()
+    uid = str(message.from_user.id)
+    user = db["users"].get(uid, {})
+    if user.get("current_family"):  # Повторное нажатие ничего не меняет и не пишет БД
+        user["current_family"] = ""  # Выходим из семьи
+        mark_db_dirty()
+
+    await message.answer(
+        "🏠 <b>Главное меню</b>\n\n"
+        "Выберите действие для управления семьями:",
+        reply_markup=get_main_menu_kb(),
+        parse_mode=ParseMode.HTML
+    )
 
-        for idx, (task_id, task) in enumerate(sorted_tasks, 1):
-            deadline_str = format_deadline(task["deadline"]) if task.get("deadline") else "⏱️ Без дедлайна"
-            bar = progress_bar(task.get("progress", 0))
-            assignees = ", ".join(task.get("assignees", [])) or "не назначена"
 
-            task_type_emoji = {
-                "shopping": "🛒", "trip": "🚗", "cleaning": "🧹",
-                "event": "🎂", "regular": "📝"
-            }.get(task["type"], "📝")
+@router.message(F.text == "✏️ Изменить ник")
+async def change_nick(message: Message, state: FSMContext) -> None:
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id = db["users"].get(uid, {}).get("current_family")
+
+    if not fam_id or fam_id not in db["families"]:
+        await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
+        return
+
+    await state.set_state(FamilyStates.change_nick)
+    await message.answer(
+        "✏️ Введите новый никнейм (до 32 символов):\n"
+        "Пример: «Мама» или «Папа»",
+        reply_markup=get_cancel_kb()
+    )
 
-            text += (
-                f"{task_type_emoji} <b>{idx}. {task['desc']}</b>\n"
-                f"   {bar} | {deadline_str}\n"
-                f"   👥 Исполнители: {assignees}\n"
-            )
-            builder.button(text=f"{idx}. {task['desc'][:25]}...", callback_data=f"task:edit:{task_id}")
 
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="✅ Завершённые задачи", callback_data="tasks:completed"))
-        builder.row(InlineKeyboardButton(text="➕ Создать задачу", callback_data="tasks:new"))
+@router.message(FamilyStates.change_nick)
+async def change_nick_handler(message: Message, state: FSMContext) -> None:
+    if message.text == "❌ Отмена":
+        await cmd_cancel(message, state)
+        return
 
-        await cq.message.edit_text(
-            text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-        await cq.answer()
+    nick = message.text.strip()[:32]
+    if not nick:
+        await message.answer("❌ Ник не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
+        return
+
+    db = load_db()
+    uid = str(message.from_user.id)
+    fam_id, fam = resolve_fam(db, uid)
 
-    @dp.message(F.text == "🏠 Вернуться в главное меню")
-    async def return_to_main_menu(message: Message, state: FSMContext) -> None:
+    if fam is None:
+        await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
         await state.clear()
-        db = load_db()
-        uid = str(message.from_user.id)
-        user = db["users"].get(uid, {})
-        user["current_family"] = ""  # Выходим из семьи
-        atomic_save_db(db)
+        return
 
-        await message.answer(
-            "🏠 <b>Главное меню</b>\n\n"
-            "Выберите действие для управления семьями:",
-            reply_markup=get_main_menu_kb(),
-            parse_mode=ParseMode.HTML
-        )
+    member = fam["members"].get(uid)
+    if member is None:
+        await message.answer("❌ Вы не состоите в этой семье!", reply_markup=get_family_menu_kb(fam["name"]))
+        await state.clear()
+        return
 
-    @dp.message(F.text == "✏️ Изменить ник")
-    async def change_nick(message: Message, state: FSMContext) -> None:
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+    if member["nick"] != nick:
+        member["nick"] = nick
+        mark_db_dirty()
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
-            return
+    await message.answer(
+        f"✅ Ник изменён на «{nick}»",
+        reply_markup=get_family_menu_kb(fam["name"])
+    )
+    await state.clear()
 
-        await state.set_state(FamilyStates.change_nick)
-        await message.answer(
-            "✏️ Введите новый никнейм (до 32 символов):\n"
-            "Пример: «Мама» или «Папа»",
-            reply_markup=get_cancel_kb()
-        )
 
-    @dp.message(FamilyStates.change_nick)
-    async def change_nick_handler(message: Message, state: FSMContext) -> None:
-        if message.text == "❌ Отмена":
-            await cmd_cancel(message, state)
-            return
+async def inject_db(handler, event, data: Dict[str, Any]) -> Any:
+    """Передаёт хендлерам живую БД (db) и id пользователя строкой (uid)"""
+    data["db"] = load_db()
+    from_user = data.get("event_from_user")
+    if from_user is not None:
+        data["uid"] = str(from_user.id)
+    return await handler(event, data)
 
-        nick = message.text.strip()[:32]
-        if not nick:
-            await message.answer("❌ Ник не может быть пустым. Попробуйте снова:", reply_markup=get_cancel_kb())
-            return
 
-        db = load_db()
-        uid = str(message.from_user.id)
-        fam_id = db["users"].get(uid, {}).get("current_family")
+def build_fsm_storage() -> BaseStorage:
+    """Хранилище состояний FSM: Redis, если задан REDIS_URL и установлен redis, иначе память процесса"""
+    redis_url = os.environ.get("REDIS_URL")
+    if not redis_url:
+        return MemoryStorage()
+    if RedisStorage is None:
+        log_error("REDIS_URL задан, но пакет redis не установлен — состояния FSM хранятся в памяти")
+        return MemoryStorage()
+    return RedisStorage.from_url(redis_url, key_builder=DefaultKeyBuilder(with_bot_id=True))
 
-        if not fam_id or fam_id not in db["families"]:
-            await message.answer("❌ Вы не в семье!", reply_markup=get_main_menu_kb())
-            await state.clear()
-            return
 
-        fam = db["families"][fam_id]
-        if uid not in fam["members"]:
-            await message.answer("❌ Вы не состоите в этой семье!", reply_markup=get_family_menu_kb(fam["name"]))
-            await state.clear()
-            return
+# Общий диспетчер: хендлеры регистрируются один раз при импорте, а не при каждом запуске
+dp = Dispatcher(storage=build_fsm_storage())
+dp.update.outer_middleware(inject_db)
+dp.include_router(router)
 
-        fam["members"][uid]["nick"] = nick
-        atomic_save_db(db)
 
-        await message.answer(
-            f"✅ Ник изменён на «{nick}»",
-            reply_markup=get_family_menu_kb(fam["name"])
-        )
-        await state.clear()
+def log_task_failure(task: asyncio.Task) -> None:
+    """Фоновые циклы бота не должны падать молча"""
+    if not task.cancelled() and task.exception() is not None:
+        log_error(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+
+async def start_bot(token: str, status_signal: pyqtSignal) -> None:
+    # Одна сессия на всё время работы — TLS-соединения переиспользуются всеми хендлерами
+    bot = Bot(token=token, session=AiohttpSession(limit=HTTP_POOL_LIMIT))
 
     # ─── ЗАПУСК БОТА ────────────────────────────────────────────────────
-    asyncio.create_task(reminders_loop(bot))
+    # Набор типов апдейтов вычисляется один раз, после регистрации всех хендлеров
+    allowed_updates = dp.resolve_used_update_types()
+    # Ограниченный пул вместо стандартного (до 32 потоков) для asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="db")
+    )
+    # BotThread создаёт новый цикл при каждом запуске — события должны принадлежать текущему
+    global _DB_DIRTY, _REMINDER_WAKE
+    _DB_DIRTY = asyncio.Event()
+    if _pending_writes:
+        _DB_DIRTY.set()
+    _REMINDER_WAKE = asyncio.Event()
+    background = [
+        asyncio.create_task(reminders_loop(bot), name="reminders_loop"),
+        asyncio.create_task(flush_loop(), name="flush_loop"),
+    ]
+    for task in background:
+        task.add_done_callback(log_task_failure)
     status_signal.emit("Бот запущен. Ожидание команд...")
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        await dp.start_polling(
+            bot,
+            allowed_updates=allowed_updates,
+            polling_timeout=POLLING_TIMEOUT,
+            handle_as_tasks=True
+        )
+    finally:
+        for task in background:
+            task.cancel()
+        # Сбрасываем несохранённые изменения при остановке
+        flush_db()
 
 
 # ────────────────────────────────────────────────
@@ -2805,6 +3330,14 @@ if __name__ == "__main__":
             f.write("# Telegram Bot Token\nTELEGRAM_BOT_TOKEN=\n")
         log_info("Created empty .env file")
 
+    if qasync is not None:
+        loop = qasync.QEventLoop(app)
+        asyncio.set_event_loop(loop)
+
     win = MainWindow()
     win.show()
+    if qasync is not None:
+        with loop:
+            loop.run_forever()
+        sys.exit(0)
     sys.exit(app.exec())